@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+import argparse
+import json
+import sys
+import time
+import benchmark_utils
+import create_kibana_dashboards
+import fake_elasticsearch
+
+
+def seed_inventory(fake_es, nr_of_installers, nr_of_pods, nr_of_versions):
+    """
+    Index one test result per testcase, installer, pod and version, which is what construct_dashboards discovers
+
+    :return: list of the synthetic installer names
+    """
+    installers = ['installer{}'.format(i) for i in range(nr_of_installers)]
+    for project_name, case_name, _ in create_kibana_dashboards._testcases:
+        for installer in installers:
+            for pod in range(nr_of_pods):
+                for version in range(nr_of_versions):
+                    fake_es.index_document('test_results', 'mongo2elastic', None, {
+                        'project_name': project_name,
+                        'case_name': case_name,
+                        'installer': installer,
+                        'pod_name': 'pod{}'.format(pod),
+                        'version': 'version{}'.format(version),
+                        'creation_date': '2016-05-03T12:34:56.123Z'
+                    })
+    return installers
+
+
+def _construct():
+    return sum(1 for dashboard in create_kibana_dashboards.construct_dashboards()
+               for _ in dashboard.saved_objects()), 0
+
+
+def _publish(batch_size, concurrency):
+    counter = {'saved_objects': 0}
+
+    def counted(dashboards):
+        for dashboard in dashboards:
+            counter['saved_objects'] += len(dashboard.versions) + 1
+            yield dashboard
+
+    nr_of_failed = create_kibana_dashboards.publish_dashboards(counted(create_kibana_dashboards.construct_dashboards()),
+                                                               batch_size, concurrency)
+    return counter['saved_objects'], nr_of_failed
+
+
+def _sync(batch_size, concurrency):
+    nr_of_failed = create_kibana_dashboards.sync_dashboards(create_kibana_dashboards.construct_dashboards(),
+                                                            batch_size, concurrency)
+    return None, nr_of_failed
+
+
+def _run_phase(run, args):
+    start_memory_kb = benchmark_utils.max_rss_kb()
+    start = time.time()
+    saved_objects, nr_of_failed = run(*args)
+    return saved_objects, nr_of_failed, time.time() - start, benchmark_utils.max_rss_kb() - start_memory_kb
+
+
+def benchmark_phase(fake_es, run, *args):
+    """
+    Run run(*args) in a fresh process, which starts with cold caches like a fresh run of the script
+    and whose memory does not include the inventory held by fake_es
+
+    :return: dict with wall time, number of http requests, bytes sent to elasticsearch and memory growth in kB
+    """
+    fake_es.reset_stats()
+    saved_objects, nr_of_failed, elapsed, memory_growth_kb = benchmark_utils.run_isolated(_run_phase, run, args)
+    result = {
+        'wall_time_s': elapsed,
+        'requests': fake_es.stats['requests'],
+        'bytes_sent': fake_es.stats['bytes_received'],
+        'bytes_received': fake_es.stats['bytes_sent'],
+        'failed': nr_of_failed,
+        'memory_growth_kb': memory_growth_kb
+    }
+    if saved_objects is not None:
+        result['saved_objects'] = saved_objects
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark create_kibana_dashboards against synthetic pod and version'
+                                                 ' inventories served by a local elasticsearch stand-in')
+    parser.add_argument('-i', '--installers', default=4, type=int,
+                        help='number of installers, defaults to 4')
+    parser.add_argument('-pd', '--pods', default=10, type=int,
+                        help='number of pods per installer, defaults to 10')
+    parser.add_argument('-v', '--versions', default=3, type=int,
+                        help='number of versions per pod, defaults to 3')
+    parser.add_argument('-bs', '--bulk-size', default=500, type=int,
+                        help='number of saved objects published in one _bulk request, defaults to 500')
+    parser.add_argument('-c', '--concurrency', default=4, type=int,
+                        help='number of _bulk requests sent at the same time, defaults to 4')
+    parser.add_argument('--latency', default=0, type=float,
+                        help='seconds added to every elasticsearch response, defaults to 0')
+    benchmark_utils.add_baseline_arguments(parser, 'benchmark_dashboards_baselines.json',
+                                           'allowed relative growth of wall time, requests and bytes sent against'
+                                           ' the baseline, defaults to 0.2')
+
+    args = parser.parse_args()
+
+    results = {}
+    with fake_elasticsearch.FakeElasticsearch(latency=args.latency) as fake_es:
+        create_kibana_dashboards._installers = set(seed_inventory(fake_es, args.installers, args.pods, args.versions))
+        create_kibana_dashboards.base_elastic_url = fake_es.url
+        create_kibana_dashboards.es_user = None
+        create_kibana_dashboards.es_passwd = None
+
+        results['construct'] = benchmark_phase(fake_es, _construct)
+        results['publish'] = benchmark_phase(fake_es, _publish, args.bulk_size, args.concurrency)
+        # nothing changed since the publish, so sync only reads the saved objects back
+        results['sync'] = benchmark_phase(fake_es, _sync, args.bulk_size, args.concurrency)
+
+    sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+    benchmark_utils.check_baseline(results, args, {'wall_time_s': False, 'requests': False, 'bytes_sent': False})
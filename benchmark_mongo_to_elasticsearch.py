@@ -0,0 +1,216 @@
+#! /usr/bin/env python
+import argparse
+import json
+import os
+import pipes
+import random
+import shutil
+import sys
+import tempfile
+import time
+import urlparse
+import benchmark_utils
+import fake_elasticsearch
+import mongo_to_elasticsearch
+
+_installers = ('fuel', 'apex', 'compass', 'joid')
+_versions = ('brahmaputra', 'colorado', 'master')
+
+
+def _common_fields(rng, project_name, case_name):
+    return {
+        '_id': {'$oid': '%024x' % rng.getrandbits(96)},
+        'installer': rng.choice(_installers),
+        'pod_name': 'pod{}'.format(rng.randint(1, 20)),
+        'version': rng.choice(_versions),
+        'project_name': project_name,
+        'case_name': case_name,
+        'creation_date': '2016-{:02}-{:02} {:02}:{:02}:{:02}.{:06}'.format(rng.randint(1, 12), rng.randint(1, 28),
+                                                                          rng.randint(0, 23), rng.randint(0, 59),
+                                                                          rng.randint(0, 59), rng.randint(0, 999999)),
+        'description': '{} {} results'.format(project_name, case_name),
+        'criteria': rng.choice(('PASS', 'FAIL'))
+    }
+
+
+def _duration(rng):
+    return '0:{:02}:{:06.3f}'.format(rng.randint(0, 59), rng.uniform(0, 59))
+
+
+def generate_rally(rng, size):
+    testcase = _common_fields(rng, 'functest', 'Rally')
+    details = [{'key': {'name': 'NovaServers.boot_server_{}'.format(i)},
+                'sla': [{'criterion': 'failure_rate', 'success': rng.random() > 0.1, 'detail': 'Failure rate'}],
+                'result': [{'duration': rng.uniform(1, 30), 'error': []} for _ in range(3)]}
+               for i in range(size)]
+    details.append({'summary': {'duration': rng.uniform(100, 3000), 'nb tests': size,
+                                'nb success': rng.uniform(80, 100)}})
+    testcase['details'] = details
+    return testcase
+
+
+def generate_odl(rng, size):
+    testcase = _common_fields(rng, 'functest', 'ODL')
+    testcase['details'] = {'details': [{'test_name': 'Check Restconf {}'.format(i),
+                                        'test_doc': 'Verify the restconf endpoint {}'.format(i),
+                                        'test_status': {'@status': 'PASS' if rng.random() > 0.1 else 'FAIL',
+                                                        '@starttime': '20160503 12:34:56.123'}}
+                                       for i in range(size)]}
+    return testcase
+
+
+def generate_onos(rng, size):
+    testcase = _common_fields(rng, 'functest', 'ONOS')
+    testcase['details'] = dict((part, {'duration': _duration(rng),
+                                       'status': [{'Case name:': '{} case {}'.format(part, i),
+                                                   'Case result': 'PASS' if rng.random() > 0.1 else 'FAIL'}
+                                                  for i in range(size)]})
+                               for part in ('FUNCvirNet', 'FUNCvirNetL3'))
+    return testcase
+
+
+def generate_vims(rng, size):
+    testcase = _common_fields(rng, 'functest', 'vIMS')
+    testcase['details'] = {
+        'sig_test': {'duration': rng.uniform(100, 600),
+                     'result': [{'name': 'Call {}'.format(i),
+                                 'duration': rng.randint(10, 5000),
+                                 'result': rng.choice(('Passed', 'Passed', 'Passed', 'Skipped', 'Failed')),
+                                 'error': ''}
+                                for i in range(size)]},
+        'vIMS': {'duration': rng.uniform(100, 600)},
+        'orchestrator': {'duration': rng.uniform(100, 600)}
+    }
+    return testcase
+
+
+def generate_tempest(rng, size):
+    testcase = _common_fields(rng, 'functest', 'Tempest')
+    testcase['details'] = {'tests': size,
+                           'failures': rng.randint(0, size // 10 + 1),
+                           'duration': _duration(rng),
+                           'errors': ['tempest.api.compute.test_{}'.format(i) for i in range(size // 20)]}
+    return testcase
+
+
+def generate_default(rng, size):
+    testcase = _common_fields(rng, 'functest', 'vPing')
+    testcase['details'] = {'duration': rng.uniform(10, 60),
+                           'status': 'OK',
+                           'timestart': time.time(),
+                           'logs': ['line {}'.format(i) for i in range(size)]}
+    return testcase
+
+
+_generators = {
+    'Rally': generate_rally,
+    'ODL': generate_odl,
+    'ONOS': generate_onos,
+    'vIMS': generate_vims,
+    'Tempest': generate_tempest,
+    'default': generate_default
+}
+
+
+def _percentile(sorted_values, percentile):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100.0))]
+
+
+def write_mongo_export(directory, case_type, nr_of_docs, size, seed):
+    """
+    Write nr_of_docs synthetic mongoexport lines of case_type into directory, together with a mongoexport
+    script printing them, so that the export runs as a command like the real one
+    """
+    rng = random.Random(seed)
+    generator = _generators[case_type]
+    export_path = os.path.join(directory, 'export.json')
+    with open(export_path, 'w') as export_fdesc:
+        for _ in range(nr_of_docs):
+            export_fdesc.write(json.dumps(generator(rng, size)) + '\n')
+
+    mongoexport_path = os.path.join(directory, 'mongoexport')
+    with open(mongoexport_path, 'w') as mongoexport_fdesc:
+        mongoexport_fdesc.write('#!/bin/sh\nexec cat {}\n'.format(pipes.quote(export_path)))
+    os.chmod(mongoexport_path, 0755)
+
+
+def _publish_mongo_data(mongoexport_directory, output_destination, nr_of_docs):
+    os.environ['PATH'] = mongoexport_directory + os.pathsep + os.environ['PATH']
+    latencies = []
+    modify_mongo_entry = mongo_to_elasticsearch.modify_mongo_entry
+
+    def timed_modify_mongo_entry(test_result):
+        transform_start = time.time()
+        try:
+            return modify_mongo_entry(test_result)
+        finally:
+            latencies.append(time.time() - transform_start)
+
+    mongo_to_elasticsearch.modify_mongo_entry = timed_modify_mongo_entry
+    start_memory_kb = benchmark_utils.max_rss_kb()
+    start = time.time()
+    published = mongo_to_elasticsearch.publish_mongo_data(output_destination)
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return {
+        'docs': nr_of_docs,
+        'published': published,
+        'docs_per_sec': nr_of_docs / elapsed if elapsed > 0 else float('inf'),
+        'transform_mean_us': 1e6 * sum(latencies) / len(latencies),
+        'transform_p50_us': 1e6 * _percentile(latencies, 50),
+        'transform_p95_us': 1e6 * _percentile(latencies, 95),
+        'memory_growth_kb': benchmark_utils.max_rss_kb() - start_memory_kb
+    }
+
+
+def benchmark_case(case_type, nr_of_docs, size, seed, latency):
+    """
+    Publish nr_of_docs synthetic test results of case_type the way mongo_to_elasticsearch does without
+    --merge-latest: a mongoexport command is streamed through modify_mongo_entry into a local elasticsearch
+    stand-in. The publishing runs in a fresh process, whose memory does not include the stand-in
+
+    :return: dict with docs_per_sec, transform latencies in microseconds, the memory in kB which the publishing
+             added, the number of http requests and of indexed documents
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        write_mongo_export(directory, case_type, nr_of_docs, size, seed)
+        with fake_elasticsearch.FakeElasticsearch(latency=latency) as fake_es:
+            output_destination = urlparse.urljoin(fake_es.url, '/{}/{}'.format(
+                mongo_to_elasticsearch._index_alias, mongo_to_elasticsearch._document_type))
+            result = benchmark_utils.run_isolated(_publish_mongo_data, directory, output_destination, nr_of_docs)
+            result['requests'] = fake_es.stats['requests']
+            result['indexed'] = len(fake_es.search(mongo_to_elasticsearch._index_alias, None, {})[0])
+    finally:
+        shutil.rmtree(directory)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark publishing synthetic mongodb test results with'
+                                                 ' mongo_to_elasticsearch into a local elasticsearch stand-in')
+    parser.add_argument('-c', '--cases', nargs='+', default=sorted(_generators), choices=sorted(_generators),
+                        help='case types to benchmark, defaults to all of them')
+    parser.add_argument('-n', '--docs', default=2000, type=int,
+                        help='number of documents per case type, defaults to 2000')
+    parser.add_argument('-s', '--size', default=50, type=int,
+                        help='number of detail entries per document, defaults to 50')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='seed of the synthetic data generators, defaults to 0')
+    parser.add_argument('--latency', default=0, type=float,
+                        help='seconds added to every elasticsearch response, defaults to 0')
+    benchmark_utils.add_baseline_arguments(parser, 'benchmark_baselines.json',
+                                           'allowed relative docs/sec drop against the baseline, defaults to 0.2')
+
+    args = parser.parse_args()
+    mongo_to_elasticsearch.es_user = None
+    mongo_to_elasticsearch.es_passwd = None
+
+    results = {}
+    for case_type in args.cases:
+        results[case_type] = benchmark_case(case_type, args.docs, args.size, args.seed, args.latency)
+
+    sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+    benchmark_utils.check_baseline(results, args, {'docs_per_sec': True})
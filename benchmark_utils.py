@@ -0,0 +1,100 @@
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import traceback
+
+
+def max_rss_kb():
+    """
+    :return: peak resident memory of the current process in kB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_child(connection, func, args):
+    try:
+        connection.send((True, func(*args)))
+    except BaseException:
+        connection.send((False, traceback.format_exc()))
+    finally:
+        connection.close()
+        # the child exits without atexit handlers, write the records queued by the loggers now
+        logging.shutdown()
+
+
+def run_isolated(func, *args):
+    """
+    Run func(*args) in a forked child process, so that memory allocated by one benchmark run does not show up
+    in the peak of the next one. The child starts with the resident memory of this process, measure growth
+    with max_rss_kb before and after the work instead of reporting the peak itself
+
+    :return: return value of func, which has to be picklable
+    """
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_run_child, args=(sender, func, args))
+    process.start()
+    sender.close()
+    try:
+        succeeded, value = receiver.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError('benchmark process died with exit code {}'.format(process.exitcode))
+    process.join()
+    if not succeeded:
+        raise RuntimeError('benchmark process failed:\n{}'.format(value))
+    return value
+
+
+def add_baseline_arguments(parser, baseline_file, tolerance_help):
+    """
+    Add the --baseline, --save-baseline and --tolerance options read by check_baseline
+
+    :param baseline_file: name of the default baseline file next to the benchmarks
+    """
+    parser.add_argument('-b', '--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                 baseline_file),
+                        help='json file with stored baselines')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline instead of comparing against it')
+    parser.add_argument('-t', '--tolerance', default=0.2, type=float, help=tolerance_help)
+
+
+def find_regressions(results, baselines, tolerance, metrics):
+    """
+    :param results: dict name -> dict metric -> value, e.g. per case or phase
+    :param metrics: dict metric -> True if higher values are better, e.g. docs/sec, False if lower ones are
+    :return: list of messages about the metrics which got worse than their baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baselines:
+            continue
+        for metric, higher_is_better in sorted(metrics.iteritems()):
+            baseline_value = baselines[name][metric]
+            if higher_is_better and result[metric] < baseline_value * (1 - tolerance):
+                regressions.append("'{}' {} dropped from {:.6g} to {:.6g}".format(name, metric, baseline_value,
+                                                                                  result[metric]))
+            elif not higher_is_better and result[metric] > baseline_value * (1 + tolerance):
+                regressions.append("'{}' {} grew from {:.6g} to {:.6g}".format(name, metric, baseline_value,
+                                                                               result[metric]))
+    return regressions
+
+
+def check_baseline(results, args, metrics):
+    """
+    Store results as the baseline with --save-baseline, otherwise compare them against the stored baseline,
+    if there is one, and exit with 1 on regressions
+    """
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_fdesc:
+            json.dump(results, baseline_fdesc, indent=2, sort_keys=True)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_fdesc:
+            regressions = find_regressions(results, json.load(baseline_fdesc), args.tolerance, metrics)
+        for regression in regressions:
+            sys.stderr.write('regression: {}\n'.format(regression))
+        if regressions:
+            sys.exit(1)
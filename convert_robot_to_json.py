@@ -3,14 +3,17 @@ import json
 import sys
 import getopt
 import requests
+import pipeline
+import profiling
 
 
 def usage():
     print """Usage:
     get-json-from-robot.py --xml=<output.xml> --pod=<pod_name> --installer=<installer>
-    -x, --xml   xml file generated by robot test
+    -x, --xml   xml file generated by robot test, may be given more than once
     -p, --pod   POD name where the test come from
     -i, --installer   
+    --profile   write cProfile stats, stage timings and peak memory as json to /var/log/convert_robot_to_json.profile.json
     -h, --help  this message
     """
     sys.exit(2)
@@ -79,39 +82,50 @@ def send_results_to_mongo(payload):
     print(response)
     print(response.text)
 
+
+def parse_robot_output(xml_file, pod, installer):
+    with profiling.span('read'):
+        with open (xml_file, "r") as myfile:
+            xml_input=myfile.read().replace('\n', '')
+
+    with profiling.span('parse'):
+        # dictionary populated with data from xml file
+        all_data = xmltodict.parse(xml_input)['robot']
+
+        data = parse_suites(all_data['suite']['suite'])
+    data['description'] = all_data['suite']['@name']
+    data['version'] = all_data['@generator']
+    data['test_project'] = "functest"
+    data['case_name'] = "ODL"
+    data['pod_name'] = pod
+    data['installer'] =  installer
+    return data
+
+
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, 'x:p:i:h', ['xml=', 'pod=', 'installer=', 'help'])
+        opts, args = getopt.getopt(argv, 'x:p:i:h', ['xml=', 'pod=', 'installer=', 'profile', 'help'])
     except getopt.GetoptError:
         usage()
 
+    xml_files = []
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             usage()
         elif opt in ('-x', '--xml'):
-            xml_file = arg
+            xml_files.append(arg)
         elif opt in ('-p', '--pod'):
             pod = arg
         elif opt in ('-i', '--installer'):
             installer = arg
+        elif opt == '--profile':
+            profiling.start('/var/log/convert_robot_to_json.log')
         else:
             usage()
 
-    with open (xml_file, "r") as myfile:
-        xml_input=myfile.read().replace('\n', '')
-
-    # dictionary populated with data from xml file
-    all_data = xmltodict.parse(xml_input)['robot']
-
-    data = parse_suites(all_data['suite']['suite'])
-    data['description'] = all_data['suite']['@name']
-    data['version'] = all_data['@generator']
-    data['test_project'] = "functest"
-    data['case_name'] = "ODL"
-    data['pod_name'] = pod
-    data['installer'] =  installer
-
-    print_to_rst(data)
+    # the next xml file is parsed while the previous one is printed
+    pipeline.run(xml_files, [pipeline.map_stage(lambda xml_file: parse_robot_output(xml_file, pod, installer))],
+                 pipeline.for_each(profiling.timed('publish', print_to_rst)))
     #print(json.dumps(data, indent=2))
     #send_results_to_mongo(data)
 
@@ -1,18 +1,42 @@
 #! /usr/bin/env python
-import logging
+import logging_utils
 import argparse
 import shared_utils
+import profiling
 import json
 import urlparse
-
-logger = logging.getLogger('create_kibana_dashboards')
-logger.setLevel(logging.DEBUG)
-file_handler = logging.FileHandler('/var/log/{}.log'.format(__name__))
-file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-logger.addHandler(file_handler)
+import sys
+import itertools
+import pipeline
+import os
+import re
+import tempfile
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+_log_path = '/var/log/create_kibana_dashboards.log'
+logger = logging_utils.get_logger('create_kibana_dashboards', _log_path)
 
 _installers = {'fuel', 'apex', 'compass', 'joid'}
 
+# terms size of every level of the pods and versions discovery
+_max_terms = 10000
+
+# caches of _get_search_source_json and _get_vis_state
+_search_source_jsons = {}
+_vis_states = {}
+_max_cached_objects = 10000
+
+_unsafe_file_chars = re.compile(r'[^A-Za-z0-9_-]')
+# first line of the landing page javascript written by JsInputsWriter
+_manifest_variable = 'var kibana_dashboard_manifest = '
+
+# kibana index pattern searched by the visualizations, None is the default index pattern
+index_pattern = None
+
+# metadata marker of the saved objects generated here, sync prunes only saved objects carrying it
+_generated_by = 'create_kibana_dashboards'
+
 # see class VisualizationState for details on format
 _testcases = [
     ('functest', 'Tempest',
@@ -443,12 +467,6 @@ class KibanaDashboard(dict):
 
         self._visualization_title = self._kibana_visualizations[0].vis_state_title
 
-    def _publish_visualizations(self):
-        for visualization in self._kibana_visualizations:
-            url = urlparse.urljoin(base_elastic_url, '/.kibana/visualization/{}'.format(visualization.id))
-            logger.debug("publishing visualization '{}'".format(url))
-            shared_utils.publish_json(visualization, es_user, es_passwd, url)
-
     def _construct_panels(self):
         size_x = 6
         size_y = 3
@@ -512,16 +530,15 @@ class KibanaDashboard(dict):
             },
                 separators=(',', ':'))
         }
-        self['metadata'] = self.visualization_detail['metadata']
-
-    def _publish(self):
-        url = urlparse.urljoin(base_elastic_url, '/.kibana/dashboard/{}'.format(self.id))
-        logger.debug("publishing dashboard '{}'".format(url))
-        shared_utils.publish_json(self, es_user, es_passwd, url)
+        self['metadata'] = dict(self.visualization_detail['metadata'], generated_by=_generated_by)
 
-    def publish(self):
-        self._publish_visualizations()
-        self._publish()
+    def saved_objects(self):
+        """
+        :return: generator of (type, id, body) of the visualizations and of the dashboard itself
+        """
+        for visualization in self._kibana_visualizations:
+            yield 'visualization', visualization.id, visualization
+        yield 'dashboard', self.id, self
 
 
 class KibanaSearchSourceJSON(dict):
@@ -543,6 +560,8 @@ class KibanaSearchSourceJSON(dict):
         ]
         if pod != 'all':
             self["filter"].append({"match": {"pod_name": {"query": pod, "type": "phrase"}}})
+        if index_pattern is not None:
+            self["index"] = index_pattern
 
 
 class VisualizationState(dict):
@@ -679,8 +698,7 @@ class KibanaVisualization(dict):
         :return:
         """
         super(KibanaVisualization, self).__init__()
-        vis_state = VisualizationState(detail)
-        self.vis_state_title = vis_state['title']
+        self.vis_state_title, vis_state_json = _get_vis_state(detail)
         self['title'] = '{} {} {} {} {} {}'.format(project_name,
                                                    case_name,
                                                    self.vis_state_title,
@@ -688,7 +706,7 @@ class KibanaVisualization(dict):
                                                    pod,
                                                    version)
         self.id = self['title'].replace(' ', '-').replace('/', '-')
-        self['visState'] = json.dumps(vis_state, separators=(',', ':'))
+        self['visState'] = vis_state_json
         self['uiStateJSON'] = "{}"
         self['description'] = "Kibana visualization for project_name '{}', case_name '{}', data '{}', installer '{}'," \
                               " pod '{}' and version '{}'".format(project_name,
@@ -698,46 +716,67 @@ class KibanaVisualization(dict):
                                                                   pod,
                                                                   version)
         self['version'] = 1
-        self['kibanaSavedObjectMeta'] = {"searchSourceJSON": json.dumps(KibanaSearchSourceJSON(project_name,
-                                                                                               case_name,
-                                                                                               installer,
-                                                                                               pod,
-                                                                                               version),
-                                                                        separators=(',', ':'))}
-
-
-def _get_pods_and_versions(project_name, case_name, installer):
-    query_json = json.JSONEncoder().encode({
-        "query": {
-            "bool": {
-                "must": [
-                    {"match_all": {}}
-                ],
-                "filter": [
-                    {"match": {"installer": {"query": installer, "type": "phrase"}}},
-                    {"match": {"project_name": {"query": project_name, "type": "phrase"}}},
-                    {"match": {"case_name": {"query": case_name, "type": "phrase"}}}
-                ]
-            }
-        }
-    })
+        self['metadata'] = {'generated_by': _generated_by}
+        self['kibanaSavedObjectMeta'] = {"searchSourceJSON": _get_search_source_json(project_name,
+                                                                                     case_name,
+                                                                                     installer,
+                                                                                     pod,
+                                                                                     version)}
 
-    elastic_data = shared_utils.get_elastic_data(urlparse.urljoin(base_elastic_url, '/test_results/mongo2elastic'),
-                                                 es_user, es_passwd, query_json)
 
-    pods_and_versions = {}
+def _get_vis_state(detail):
+    """
+    :return: tuple of title and serialized VisualizationState of detail, built once per _testcases entry
+    """
+    try:
+        cached_detail, title, vis_state_json = _vis_states[id(detail)]
+        if cached_detail is detail:
+            return title, vis_state_json
+    except KeyError:
+        pass
+    vis_state = VisualizationState(detail)
+    title, vis_state_json = vis_state['title'], json.dumps(vis_state, separators=(',', ':'))
+    # keep detail referenced, so that its id is not reused
+    _vis_states[id(detail)] = detail, title, vis_state_json
+    return title, vis_state_json
+
+
+def _get_search_source_json(project_name, case_name, installer, pod, version):
+    # the filter is the same for all visualization details of a testcase
+    key = (project_name, case_name, installer, pod, version)
+    try:
+        return _search_source_jsons[key]
+    except KeyError:
+        if len(_search_source_jsons) >= _max_cached_objects:
+            _search_source_jsons.clear()
+        search_source_json = json.dumps(KibanaSearchSourceJSON(project_name, case_name, installer, pod, version),
+                                        separators=(',', ':'))
+        _search_source_jsons[key] = search_source_json
+        return search_source_json
+
+
+def _get_pods_and_versions():
+    """
+    Discover the pods and versions of all project_name/case_name/installer combinations
+    with a single nested terms aggregation instead of downloading the test results
 
-    for data in elastic_data:
-        pod = data['pod_name']
-        if pod in pods_and_versions:
-            pods_and_versions[pod].add(data['version'])
-        else:
-            pods_and_versions[pod] = {data['version']}
+    :return: dict (project_name, case_name, installer) -> dict pod -> set of versions, pod 'all' has every version
+    """
+    fields = ('project_name', 'case_name', 'installer', 'pod_name', 'version')
+    # dynamically mapped strings are analyzed text, their keyword sub-field holds the exact values
+    bucket_aggs = [(field, {'terms': {'field': '{}.keyword'.format(field), 'size': _max_terms}}) for field in fields]
+    query = {"bool": {"filter": [{"terms": {"installer.keyword": sorted(_installers)}}]}}
 
-        if 'all' in pods_and_versions:
-            pods_and_versions['all'].add(data['version'])
-        else:
-            pods_and_versions['all'] = {data['version']}
+    pods_and_versions = {}
+    with profiling.span('read'):
+        aggregations = shared_utils.search_aggregations(
+            urlparse.urljoin(base_elastic_url, '/test_results/mongo2elastic'), es_user, es_passwd,
+            shared_utils.nest_aggregations(bucket_aggs), query)
+    for (project_name, case_name, installer, pod, version), _ in shared_utils.iter_nested_buckets(aggregations,
+                                                                                                   fields):
+        testcase_pods = pods_and_versions.setdefault((project_name, case_name, installer), {})
+        testcase_pods.setdefault(pod, set()).add(version)
+        testcase_pods.setdefault('all', set()).add(version)
 
     return pods_and_versions
 
@@ -745,49 +784,237 @@ def _get_pods_and_versions(project_name, case_name, installer):
 def construct_dashboards():
     """
     iterate over testcase and installer
-    1. get available pods for each testcase/installer pair
-    2. get available version for each testcase/installer/pod tuple
-    3. construct KibanaInput and append
+    1. get available pods and versions of all testcase/installer pairs in one aggregation
+    2. look up the pods and versions of each testcase/installer pair
+    3. construct KibanaInput and yield it
 
-    :return: list of KibanaDashboards
+    :return: generator of KibanaDashboards
     """
-    kibana_dashboards = []
+    all_pods_and_versions = _get_pods_and_versions()
     for project_name, case_name, visualization_details in _testcases:
         for installer in _installers:
-            pods_and_versions = _get_pods_and_versions(project_name, case_name, installer)
+            pods_and_versions = all_pods_and_versions.get((project_name, case_name, installer), {})
             for visualization_detail in visualization_details:
                 for pod, versions in pods_and_versions.iteritems():
-                    kibana_dashboards.append(KibanaDashboard(project_name, case_name, installer, pod, versions,
-                                                             visualization_detail))
-    return kibana_dashboards
+                    yield KibanaDashboard(project_name, case_name, installer, pod, versions, visualization_detail)
 
 
-def generate_js_inputs(js_file_path, kibana_url, dashboards):
-    js_dict = {}
-    for dashboard in dashboards:
-        dashboard_meta = dashboard['metadata']
-        test_family = dashboard_meta['test_family']
-        test_label = dashboard_meta['label']
+def _send_batch(actions):
+    try:
+        return shared_utils.bulk_request(actions, es_user, es_passwd, urlparse.urljoin(base_elastic_url, '/_bulk'))
+    except Exception as error:
+        return [(action, str(error)) for action, _ in actions]
+
+
+def _get_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _send_actions(actions, batch_size, concurrency):
+    """
+    Send (action, source) tuples through _bulk requests of batch_size actions,
+    at most concurrency requests are sent at the same time
+
+    :return: number of actions which failed
+    """
+    nr_of_failed = 0
+    batches = pipeline.BoundedIterable(_get_batches(actions, batch_size), concurrency * 2)
+    pool = ThreadPool(concurrency)
+    try:
+        for errors in pool.imap_unordered(profiling.timed('publish', _send_batch), batches):
+            batches.release()
+            for action, error in errors:
+                action_type, action_meta = action.items()[0]
+                logger.error("{} of {} '{}' failed: {}".format(action_type, action_meta['_type'], action_meta['_id'],
+                                                               error))
+            nr_of_failed += len(errors)
+        pool.close()
+    except BaseException:
+        batches.stop()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return nr_of_failed
+
+
+def _index_action(object_type, object_id, body):
+    # the content hash is stored with the saved object, so that sync only has to read the metadata back
+    body = dict(body, metadata=dict(body['metadata'], content_hash=_get_content_hash(body)))
+    return {'index': {'_index': '.kibana', '_type': object_type, '_id': object_id}}, body
+
+
+def _iter_saved_objects(dashboards):
+    return itertools.chain.from_iterable(dashboard.saved_objects() for dashboard in dashboards)
+
+
+def publish_dashboards(dashboards, batch_size=500, concurrency=4):
+    """
+    Publish the saved objects of dashboards into .kibana
+
+    :return: number of saved objects which could not be published
+    """
+    actions = (_index_action(*saved_object) for saved_object in _iter_saved_objects(dashboards))
+    return _send_actions(actions, batch_size, concurrency)
+
+
+def _get_content_hash(body):
+    # of the body as generated, without the content_hash added to its metadata when it is published
+    return hashlib.sha1(json.dumps(body, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def _is_generated(body):
+    # saved objects created by hand may share the id prefix of generated ones, but not the marker
+    metadata = body.get('metadata')
+    return isinstance(metadata, dict) and metadata.get('generated_by') == _generated_by
+
+
+def sync_dashboards(dashboards, batch_size=500, concurrency=4):
+    """
+    Publish only the saved objects of dashboards which are new or whose content changed
+    and delete the saved objects marked as generated which are not generated anymore.
+    Only the metadata of the existing saved objects is read, which holds the content hash stored at publishing
+
+    :return: number of saved objects which could not be published or deleted
+    """
+    existing_hashes = {}
+    hits = shared_utils.iter_elastic_hits(urlparse.urljoin(base_elastic_url, '/.kibana/visualization,dashboard'),
+                                          es_user, es_passwd, body=json.dumps({'_source': ['metadata']}))
+    for hit in profiling.timed_iter('read', hits):
+        if _is_generated(hit['_source']):
+            # saved objects published without a content hash are published again
+            existing_hashes[(hit['_type'], hit['_id'])] = hit['_source']['metadata'].get('content_hash')
+
+    counts = {'unchanged': 0, 'published': 0}
+
+    def changed_actions():
+        for object_type, object_id, body in _iter_saved_objects(dashboards):
+            if existing_hashes.pop((object_type, object_id), None) == _get_content_hash(body):
+                counts['unchanged'] += 1
+            else:
+                counts['published'] += 1
+                yield _index_action(object_type, object_id, body)
+
+    nr_of_failed = _send_actions(changed_actions(), batch_size, concurrency)
+
+    # whatever is left was not generated in this run
+    delete_actions = [({'delete': {'_index': '.kibana', '_type': object_type, '_id': object_id}}, None)
+                      for object_type, object_id in existing_hashes]
+    nr_of_failed += _send_actions(delete_actions, batch_size, concurrency)
+
+    logger.info('saved objects published: {}, unchanged: {}, deleted: {}'.format(counts['published'],
+                                                                               counts['unchanged'],
+                                                                               len(delete_actions)))
+    return nr_of_failed
 
-        if test_family not in js_dict:
-            js_dict[test_family] = {}
 
-        js_test_family = js_dict[test_family]
+class JsInputsWriter(object):
+    def __init__(self, kibana_url):
+        """
+        Collect the dashboard links for the kibana landing page as dashboards stream by, only the links are kept
+        """
+        self.kibana_url = kibana_url
+        self._js_dict = {}
 
-        if test_label not in js_test_family:
-            js_test_family[test_label] = {}
+    def add(self, dashboard):
+        dashboard_meta = dashboard['metadata']
+        js_test_family = self._js_dict.setdefault(dashboard_meta['test_family'], {})
+        js_test_label = js_test_family.setdefault(dashboard_meta['label'], {})
+        js_installer = js_test_label.setdefault(dashboard.installer, {})
+        js_installer[dashboard.pod] = dashboard.id
 
-        js_test_label = js_test_family[test_label]
+    def record(self, dashboards):
+        """
+        Pass dashboards through while adding them
+        """
+        for dashboard in dashboards:
+            self.add(dashboard)
+            yield dashboard
 
-        if dashboard.installer not in js_test_label:
-            js_test_label[dashboard.installer] = {}
+    def write(self, js_file_path):
+        """
+        Write one json file per test family next to js_file_path, named by its content hash so that it can be
+        cached for long, and js_file_path with a small manifest pointing to them:
+            var kibana_dashboard_manifest = {
+                "dashboard_url": <kibana url>#/dashboard/,
+                "test_families": {<test family>: <file name>}
+            };
+            var kibana_dashboard_links = <test family -> label -> installer -> pod -> dashboard url>;
+        A test family file maps label -> installer -> pod -> dashboard id. kibana_dashboard_links is kept for
+        landing pages which do not read the manifest yet. Test family files of the previous manifest are kept,
+        so that pages which loaded it can still fetch them
+        """
+        directory = os.path.dirname(os.path.abspath(js_file_path))
+        previous_files = _read_manifest_files(js_file_path)
+        test_family_files = {}
+        for test_family, js_test_family in self._js_dict.iteritems():
+            content = json.dumps(js_test_family, sort_keys=True, separators=(',', ':'))
+            file_name = 'kibana_dashboards_{}.{}.json'.format(_unsafe_file_chars.sub('_', test_family),
+                                                              hashlib.sha1(content).hexdigest()[:12])
+            _write_atomically(os.path.join(directory, file_name), content)
+            test_family_files[test_family] = file_name
+
+        dashboard_url = self.kibana_url + '#/dashboard/'
+        manifest = {
+            "dashboard_url": dashboard_url,
+            "test_families": test_family_files
+        }
+        links = {}
+        for test_family, js_test_family in self._js_dict.iteritems():
+            for label, js_test_label in js_test_family.iteritems():
+                for installer, js_installer in js_test_label.iteritems():
+                    links.setdefault(test_family, {}).setdefault(label, {})[installer] = dict(
+                        (pod, dashboard_url + dashboard_id) for pod, dashboard_id in js_installer.iteritems())
+        _write_atomically(js_file_path, '{}{};\nvar kibana_dashboard_links = {};\n'.format(
+            _manifest_variable, json.dumps(manifest, sort_keys=True), json.dumps(links, sort_keys=True)))
+
+        # test family files of older runs
+        kept_files = previous_files.union(test_family_files.itervalues())
+        for file_name in os.listdir(directory):
+            if file_name.startswith('kibana_dashboards_') and file_name.endswith('.json') \
+                    and file_name not in kept_files:
+                os.remove(os.path.join(directory, file_name))
+
+
+def _read_manifest_files(js_file_path):
+    """
+    :return: set of the test family file names in the manifest written to js_file_path by the previous run
+    """
+    try:
+        with open(js_file_path) as js_file:
+            manifest_line = js_file.readline()
+    except IOError:
+        return set()
+    if not manifest_line.startswith(_manifest_variable):
+        # conf.js of the version before the manifest
+        return set()
+    manifest = json.loads(manifest_line[len(_manifest_variable):].rstrip().rstrip(';'))
+    return set(manifest['test_families'].itervalues())
+
+
+def _write_atomically(file_path, content):
+    # readers see either the old or the new file, never a partially written one
+    tmp_fdesc, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), prefix='.tmp')
+    try:
+        with os.fdopen(tmp_fdesc, 'w') as tmp_file:
+            tmp_file.write(content)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
-        js_installer = js_test_label[dashboard.installer]
-        js_installer[dashboard.pod] = kibana_url + '#/dashboard/' + dashboard.id
 
-    with open(js_file_path, 'w+') as js_file_fdesc:
-        js_file_fdesc.write('var kibana_dashboard_links = ')
-        js_file_fdesc.write(str(js_dict).replace("u'", "'"))
+def generate_js_inputs(js_file_path, kibana_url, dashboards):
+    js_inputs = JsInputsWriter(kibana_url)
+    for dashboard in dashboards:
+        js_inputs.add(dashboard)
+    js_inputs.write(js_file_path)
 
 
 if __name__ == '__main__':
@@ -797,28 +1024,58 @@ if __name__ == '__main__':
     parser.add_argument('-js', '--generate_js_inputs', action='store_true',
                         help='Use this argument to generate javascript inputs for kibana landing page')
     parser.add_argument('--js_path', default='/usr/share/nginx/html/kibana_dashboards/conf.js',
-                        help='Path of javascript file with inputs for kibana landing page')
+                        help='Path of javascript manifest for kibana landing page,'
+                             ' the per test family json files are written next to it')
     parser.add_argument('-k', '--kibana_url', default='https://testresults.opnfv.org/kibana/app/kibana',
                         help='The url of kibana for javascript inputs')
 
+    parser.add_argument('-b', '--bulk-size', default=500, type=int,
+                        help='number of saved objects published in one _bulk request, defaults to 500')
+    parser.add_argument('-c', '--concurrency', default=4, type=int,
+                        help='number of _bulk requests sent at the same time, defaults to 4')
+
+    parser.add_argument('-s', '--sync', action='store_true',
+                        help='publish only new or changed saved objects and delete generated saved objects'
+                             ' which are not generated anymore')
+
+    parser.add_argument('-ip', '--index-pattern',
+                        help='kibana index pattern searched by the visualizations, e.g. test_results_rollup for'
+                             ' the daily summaries of rollup_test_results. Defaults to the default index pattern')
+
     parser.add_argument('-u', '--elasticsearch-username',
                         help='the username for elasticsearch')
 
     parser.add_argument('-p', '--elasticsearch-password',
                         help='the password for elasticsearch')
 
+    parser.add_argument('--profile', action='store_true',
+                        help='write cProfile stats, stage timings and peak memory as json next to the log')
+
     args = parser.parse_args()
+    if args.profile:
+        profiling.start(_log_path)
     base_elastic_url = args.elasticsearch_url
+    index_pattern = args.index_pattern
     generate_inputs = args.generate_js_inputs
     input_file_path = args.js_path
     kibana_url = args.kibana_url
     es_user = args.elasticsearch_username
     es_passwd = args.elasticsearch_password
 
-    dashboards = construct_dashboards()
+    # dashboards are generated, published and recorded for the js inputs one at a time
+    dashboards = profiling.timed_iter('transform', construct_dashboards())
+    if generate_inputs:
+        js_inputs = JsInputsWriter(kibana_url)
+        dashboards = js_inputs.record(dashboards)
 
-    for kibana_dashboard in dashboards:
-        kibana_dashboard.publish()
+    if args.sync:
+        nr_of_failed = sync_dashboards(dashboards, args.bulk_size, args.concurrency)
+    else:
+        nr_of_failed = publish_dashboards(dashboards, args.bulk_size, args.concurrency)
 
     if generate_inputs:
-        generate_js_inputs(input_file_path, kibana_url, dashboards)
+        js_inputs.write(input_file_path)
+
+    if nr_of_failed > 0:
+        logger.error('{} saved objects could not be published'.format(nr_of_failed))
+        sys.exit(1)
@@ -1,37 +1,117 @@
+import argparse
 import json
+import os
 import sys
 #import time
 
-data = json.load(sys.stdin)
+# the shared modules live in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import json_stream
+import logstash_utils
+import pipeline
 
-for test_result in data["test_results"]:
 
+_jsonl_hint = 'use -f jsonl for json lines'
+
+
+def read_test_results(fobj, input_format):
+  """
+  Yield test results one at a time from
+    object: {"test_results": [test results]}
+    array: [test results]
+    jsonl: one test result per line
+  auto picks array for '[' and object otherwise, jsonl has to be asked for. A json lines input read as object
+  fails with a ValueError, at the latest when a second top level value follows the first one
+  """
+  if input_format == 'jsonl':
+    for line in fobj:
+      if line.strip():
+        yield json.loads(line)
+    return
+
+  reader = json_stream.JsonStreamReader(fobj)
+  if input_format == 'auto':
+    try:
+      first_char = reader.peek()
+    except ValueError:
+      # empty input
+      return
+    # "test_results" need not be the first key, so an object cannot be told apart from the first json line
+    input_format = 'array' if first_char == '[' else 'object'
+
+  if input_format == 'object':
+    results = reader.iter_array('test_results')
+  else:
+    results = reader.iter_array()
+
+  try:
+    for test_result in results:
+      yield test_result
+  except KeyError:
+    raise ValueError('No "test_results" in the top level json object, {}'.format(_jsonl_hint))
+
+  try:
+    reader.peek()
+  except ValueError:
+    # end of input
+    return
+  raise ValueError('More json values follow the test results, {}'.format(_jsonl_hint))
+
+
+def explode(test_result):
+  """
+  Yield one result per detail. The yielded result is a single shallow copy of test_result whose details are
+  replaced for every detail, so it has to be serialized before the next one is requested
+  """
   if test_result["case_name"] == "Rally":
-    tmp_result = test_result
-    for detail in  test_result["details"]:
+    tmp_result = dict(test_result)
+    for detail in test_result["details"]:
       tmp_result["details"] = {"sla": detail["sla"][0], "name": detail["key"]["name"]}
-      print(json.dumps(tmp_result))
-    continue
+      yield tmp_result
 
-  if test_result["case_name"] == "vIMS":
-    tmp_result = test_result
+  elif test_result["case_name"] == "vIMS":
+    tmp_result = dict(test_result)
     for ims_case in test_result["details"]["sig_test"]["result"]:
       tmp_result["details"] = ims_case
-      print(json.dumps(tmp_result))
-    continue
+      yield tmp_result
 
-  if test_result["case_name"] == "ODL":
-    tmp_result = test_result
+  elif test_result["case_name"] == "ODL" or test_result["project_name"] == "yardstick":
+    tmp_result = dict(test_result)
     for detail in test_result["details"]:
       tmp_result["details"] = detail
-      print(json.dumps(tmp_result))
-    continue
+      yield tmp_result
 
-  if test_result["project_name"] == "yardstick":
-    tmp_result = test_result
-    for detail in test_result["details"]:
-      tmp_result["details"] = detail
-      print(json.dumps(tmp_result))
-    continue
+  else:
+    yield test_result
+
+
+def explode_lines(test_result):
+  """
+  Timestamp and explode test_result into json lines, the exploded results are serialized right away
+  because explode reuses them
+  """
+  return [json.dumps(result) for result in explode(logstash_utils.add_timestamp(test_result))]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Split test result details into one json per detail')
+  parser.add_argument('-f', '--input-format', default='auto', choices=('auto', 'object', 'array', 'jsonl'),
+                      help='format of the test results on stdin, defaults to auto, which reads a json array'
+                           ' or an object with test_results. Json lines need -f jsonl')
+  parser.add_argument('-l', '--logstash', metavar='HOST:PORT',
+                      help='send json lines to a logstash tcp input with json_lines codec instead of printing them')
+  args = parser.parse_args()
+
+  if args.logstash is not None:
+    sink = logstash_utils.JsonLinesTcpSink(*logstash_utils.parse_address(args.logstash))
+    write_line = sink.write_line
+  else:
+    sink = os.fdopen(sys.stdout.fileno(), 'w', 1 << 20)
+    write_line = lambda line: sink.write(line + '\n')
 
-  print(json.dumps(test_result))
+  try:
+    # test results can be large, so only a few of them, or of their lists of lines, wait between the stages
+    pipeline.run(read_test_results(sys.stdin, args.input_format), [pipeline.map_stage(explode_lines)],
+                 pipeline.for_each_in_lists(write_line), queue_size=4, chunk_size=1)
+  finally:
+    sink.close()
@@ -0,0 +1,540 @@
+#! /usr/bin/env python
+import argparse
+import BaseHTTPServer
+import SocketServer
+import calendar
+import datetime
+import fnmatch
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urlparse
+
+_date_formats = ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                 '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+_date_math = re.compile(r'now(?:([+-])(\d+)([smhdwMy]))?$')
+_interval_units = {'s': 1000, 'm': 60 * 1000, 'h': 3600 * 1000, 'd': 24 * 3600 * 1000, 'w': 7 * 24 * 3600 * 1000}
+_keyword_suffix = '.keyword'
+_named_intervals = {'second': '1s', 'minute': '1m', 'hour': '1h', 'day': '1d', 'week': '1w'}
+
+
+def _to_millis(value):
+    """
+    :return: milliseconds since epoch of a date value or None if value is not a date
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, long, float)):
+        return value
+    if not isinstance(value, basestring):
+        return None
+    math = _date_math.match(value)
+    if math is not None:
+        now = time.time() * 1000
+        if math.group(1) is None:
+            return now
+        unit = math.group(3)
+        # months and years are approximated, which is good enough for relative ranges
+        unit_millis = {'M': 30 * _interval_units['d'], 'y': 365 * _interval_units['d']}.get(unit) or \
+            _interval_units[unit]
+        delta = int(math.group(2)) * unit_millis
+        return now - delta if math.group(1) == '-' else now + delta
+    for date_format in _date_formats:
+        try:
+            date = datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        return calendar.timegm(date.timetuple()) * 1000 + date.microsecond // 1000
+    return None
+
+
+def _get_field(source, field):
+    if field.endswith(_keyword_suffix):
+        # every string behaves as if it was mapped as text with a keyword sub-field
+        field = field[:-len(_keyword_suffix)]
+    value = source
+    for key in field.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            # documents may also contain dotted keys
+            return source.get(field) if isinstance(source, dict) else None
+        value = value[key]
+    return value
+
+
+def _get_values(source, field):
+    value = _get_field(source, field)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _filter_source(source, source_filter):
+    """
+    :param source_filter: _source of a search body, a field or a list of fields without wildcards
+    :return: copy of source with only the listed fields
+    """
+    filtered = {}
+    for field in [source_filter] if isinstance(source_filter, basestring) else source_filter:
+        value = _get_field(source, field)
+        if value is not None:
+            keys = field.split('.')
+            parent = filtered
+            for key in keys[:-1]:
+                parent = parent.setdefault(key, {})
+            parent[keys[-1]] = value
+    return filtered
+
+
+def _compare(value, bound):
+    value_millis = _to_millis(value) if isinstance(value, basestring) else None
+    bound_millis = _to_millis(bound) if isinstance(bound, basestring) else None
+    if value_millis is not None and bound_millis is not None:
+        return cmp(value_millis, bound_millis)
+    return cmp(value, bound)
+
+
+def _matches(query, source, doc_id):
+    """
+    Evaluate the subset of the query dsl the scripts use against source
+    """
+    if not query or 'match_all' in query:
+        return True
+    if 'bool' in query:
+        bool_query = query['bool']
+
+        def clauses(name):
+            clause = bool_query.get(name, [])
+            return clause if isinstance(clause, list) else [clause]
+
+        return all(_matches(clause, source, doc_id) for clause in clauses('must') + clauses('filter')) and \
+            not any(_matches(clause, source, doc_id) for clause in clauses('must_not')) and \
+            (not clauses('should') or any(_matches(clause, source, doc_id) for clause in clauses('should')))
+    if 'match' in query or 'term' in query or 'match_phrase' in query:
+        field, expected = (query.get('match') or query.get('term') or query.get('match_phrase')).items()[0]
+        if isinstance(expected, dict):
+            expected = expected.get('query', expected.get('value'))
+        return expected in _get_values(source, field)
+    if 'terms' in query:
+        field, expected = query['terms'].items()[0]
+        return any(value in expected for value in _get_values(source, field))
+    if 'range' in query:
+        field, bounds = query['range'].items()[0]
+        checks = {'gt': lambda c: c > 0, 'gte': lambda c: c >= 0, 'lt': lambda c: c < 0, 'lte': lambda c: c <= 0}
+        return any(all(checks[name](_compare(value, bound)) for name, bound in bounds.iteritems() if name in checks)
+                   for value in _get_values(source, field))
+    if 'exists' in query:
+        return bool(_get_values(source, query['exists']['field']))
+    if 'ids' in query:
+        return doc_id in query['ids']['values']
+    if 'query_string' in query:
+        return query['query_string'].get('query', '*') == '*'
+    raise ValueError('Unsupported query {}'.format(json.dumps(query)))
+
+
+def _metric(metric_type, params, docs):
+    values = [value for doc in docs for value in _get_values(doc['_source'], params['field'])
+              if isinstance(value, (int, long, float)) and not isinstance(value, bool)]
+    if metric_type == 'value_count':
+        return {'value': len(values)}
+    if not values:
+        return {'value': 0 if metric_type == 'sum' else None}
+    if metric_type == 'avg':
+        return {'value': float(sum(values)) / len(values)}
+    return {'value': {'sum': sum, 'min': min, 'max': max}[metric_type](values)}
+
+
+def _interval_millis(interval):
+    interval = _named_intervals.get(interval, interval)
+    return int(interval[:-1]) * _interval_units[interval[-1]]
+
+
+def _histogram_keys(params, doc):
+    interval = _interval_millis(params.get('fixed_interval') or params.get('calendar_interval') or params['interval'])
+    return [millis - millis % interval for millis in (_to_millis(value) for value in _get_values(doc['_source'],
+                                                                                                params['field']))
+            if millis is not None]
+
+
+def _aggregate(aggs, docs):
+    results = {}
+    for name, agg in aggs.iteritems():
+        sub_aggs = agg.get('aggs') or agg.get('aggregations') or {}
+        if 'terms' in agg:
+            groups = {}
+            for doc in docs:
+                for value in set(_get_values(doc['_source'], agg['terms']['field'])):
+                    groups.setdefault(value, []).append(doc)
+            ordered = sorted(groups.iteritems(), key=lambda group: (-len(group[1]), group[0]))
+            buckets = []
+            for key, bucket_docs in ordered[:agg['terms'].get('size', 10)]:
+                bucket = {'key': key, 'doc_count': len(bucket_docs)}
+                bucket.update(_aggregate(sub_aggs, bucket_docs))
+                buckets.append(bucket)
+            results[name] = {'buckets': buckets, 'sum_other_doc_count': sum(len(group[1])
+                                                                           for group in ordered[len(buckets):])}
+        elif 'date_histogram' in agg:
+            # only the buckets with documents, as with min_doc_count 1
+            groups = {}
+            for doc in docs:
+                for key in set(_histogram_keys(agg['date_histogram'], doc)):
+                    groups.setdefault(key, []).append(doc)
+            buckets = []
+            for key, bucket_docs in sorted(groups.iteritems()):
+                bucket = {'key': key, 'doc_count': len(bucket_docs)}
+                bucket.update(_aggregate(sub_aggs, bucket_docs))
+                buckets.append(bucket)
+            results[name] = {'buckets': buckets}
+        else:
+            metric_type, params = agg.items()[0]
+            if metric_type not in ('avg', 'sum', 'min', 'max', 'value_count'):
+                raise ValueError('Unsupported aggregation {}'.format(json.dumps(agg)))
+            results[name] = _metric(metric_type, params, docs)
+    return results
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeElasticsearch(object):
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0, throttle_rate=0,
+                 max_requests_per_second=None, seed=0, item_reject_rate=0):
+        """
+        In-process http stand-in for the elasticsearch endpoints used by the scripts in this repository:
+        _search with size, _source filtering, scroll and terms/date_histogram/metric aggregations, _search/scroll,
+        _bulk, document PUT/POST/GET/DELETE, index DELETE, _template and _cat/indices
+
+        :param latency: seconds added to every response
+        :param error_rate: probability of answering 500
+        :param throttle_rate: probability of answering 429
+        :param max_requests_per_second: requests above this rate within a second are answered with 429
+        :param seed: seed of the error and throttle injection, so that runs are reproducible
+        :param item_reject_rate: probability of rejecting a single _bulk item with es_rejected_execution_exception
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.item_reject_rate = item_reject_rate
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._indices = {}
+        self._aliases = {}
+        self._templates = {}
+        self._scrolls = {}
+        self._ids = itertools.count(1)
+        self._second = None
+        self._requests_in_second = 0
+        self.stats = {}
+        self.reset_stats()
+        self._server = _ThreadingHTTPServer((host, port), self._create_handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0, 'errors': 0, 'throttled': 0,
+                          'endpoints': {}}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    # storage
+
+    def _create_index(self, index):
+        if index not in self._indices:
+            self._indices[index] = {}
+            for template in self._templates.itervalues():
+                patterns = template.get('index_patterns') or [template.get('template')]
+                if any(pattern and fnmatch.fnmatch(index, pattern) for pattern in patterns):
+                    for alias in template.get('aliases', {}):
+                        self._aliases.setdefault(alias, set()).add(index)
+        return self._indices[index]
+
+    def index_document(self, index, doc_type, doc_id, source):
+        """
+        :return: True if the document was created, False if it was replaced
+        """
+        with self._lock:
+            if doc_id is None:
+                doc_id = 'fake{}'.format(next(self._ids))
+            documents = self._create_index(index).setdefault(doc_type, {})
+            created = doc_id not in documents
+            documents[doc_id] = source
+            return doc_id, created
+
+    def delete_document(self, index, doc_type, doc_id):
+        with self._lock:
+            return self._indices.get(index, {}).get(doc_type, {}).pop(doc_id, None) is not None
+
+    def _resolve_indices(self, index_expr):
+        indices = set()
+        for name in index_expr.split(','):
+            if name in ('_all', '*'):
+                indices.update(self._indices)
+            elif name in self._aliases:
+                indices.update(self._aliases[name])
+            else:
+                indices.update(index for index in self._indices if fnmatch.fnmatch(index, name))
+        return sorted(indices)
+
+    def search(self, index_expr, type_expr, body):
+        """
+        :return: list of matching hits and the aggregation results
+        """
+        query = body.get('query')
+        types = None if type_expr is None else set(type_expr.split(','))
+        with self._lock:
+            hits = []
+            for index in self._resolve_indices(index_expr):
+                for doc_type, documents in sorted(self._indices[index].iteritems()):
+                    if types is not None and doc_type not in types:
+                        continue
+                    for doc_id, source in sorted(documents.iteritems()):
+                        if _matches(query, source, doc_id):
+                            hits.append({'_index': index, '_type': doc_type, '_id': doc_id, '_score': 1.0,
+                                         '_source': source})
+        aggregations = _aggregate(body.get('aggs') or body.get('aggregations') or {}, hits)
+        source_filter = body.get('_source', True)
+        if source_filter is False:
+            hits = [dict((key, value) for key, value in hit.iteritems() if key != '_source') for hit in hits]
+        elif source_filter is not True:
+            hits = [dict(hit, _source=_filter_source(hit['_source'], source_filter)) for hit in hits]
+        return hits, aggregations
+
+    # http
+
+    def _inject_failure(self):
+        with self._lock:
+            if self.max_requests_per_second is not None:
+                second = int(time.time())
+                if second != self._second:
+                    self._second = second
+                    self._requests_in_second = 0
+                self._requests_in_second += 1
+                if self._requests_in_second > self.max_requests_per_second:
+                    self.stats['throttled'] += 1
+                    return 429
+            roll = self._random.random()
+            if roll < self.throttle_rate:
+                self.stats['throttled'] += 1
+                return 429
+            if roll < self.throttle_rate + self.error_rate:
+                self.stats['errors'] += 1
+                return 500
+        return None
+
+    def handle(self, method, path, query_params, body):
+        """
+        :return: tuple of http status and json response
+        """
+        parts = [part for part in path.split('/') if part]
+        endpoint = '{} {}'.format(method, '/'.join(part if part.startswith('_') else '*' for part in parts))
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_received'] += len(body)
+            self.stats['endpoints'][endpoint] = self.stats['endpoints'].get(endpoint, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        failure = self._inject_failure()
+        if failure == 429:
+            return 429, {'error': {'type': 'es_rejected_execution_exception', 'reason': 'injected throttling'},
+                         'status': 429}
+        elif failure == 500:
+            return 500, {'error': {'type': 'exception', 'reason': 'injected error'}, 'status': 500}
+
+        try:
+            json_body = json.loads(body) if body and parts[-1:] != ['_bulk'] else {}
+            return self._route(method, parts, query_params, json_body, body)
+        except (ValueError, KeyError) as error:
+            return 400, {'error': {'type': 'parse_exception', 'reason': str(error)}, 'status': 400}
+
+    def _route(self, method, parts, query_params, json_body, body):
+        if parts == ['_bulk'] or parts[-1:] == ['_bulk']:
+            return self._bulk(body)
+        if parts == ['_search', 'scroll']:
+            if method == 'DELETE':
+                with self._lock:
+                    self._scrolls.pop(json_body.get('scroll_id'), None)
+                return 200, {'succeeded': True}
+            return self._scroll(json_body['scroll_id'], None)
+        if parts[:1] == ['_template'] and len(parts) == 2:
+            with self._lock:
+                self._templates[parts[1]] = json_body
+            return 200, {'acknowledged': True}
+        if parts[:2] == ['_cat', 'indices']:
+            with self._lock:
+                indices = self._resolve_indices(parts[2]) if len(parts) > 2 else sorted(self._indices)
+            return 200, [{'index': index} for index in indices]
+        if parts[-1:] == ['_search'] and len(parts) in (2, 3):
+            return self._search(parts[0], parts[1] if len(parts) == 3 else None, query_params, json_body)
+
+        if len(parts) == 1 and method == 'DELETE':
+            with self._lock:
+                deleted = [index for index in self._resolve_indices(parts[0]) if self._indices.pop(index, None)]
+                for alias_indices in self._aliases.itervalues():
+                    alias_indices.difference_update(deleted)
+            return (200, {'acknowledged': True}) if deleted else (404, {'status': 404})
+        if len(parts) == 1 and method == 'PUT':
+            with self._lock:
+                self._create_index(parts[0])
+            return 200, {'acknowledged': True}
+        if len(parts) == 2 and method == 'POST':
+            doc_id, created = self.index_document(parts[0], parts[1], None, json_body)
+            return 201, {'_index': parts[0], '_type': parts[1], '_id': doc_id, 'created': created}
+        if len(parts) == 3:
+            index, doc_type, doc_id = parts
+            if method in ('PUT', 'POST'):
+                _, created = self.index_document(index, doc_type, doc_id, json_body)
+                return 201 if created else 200, {'_index': index, '_type': doc_type, '_id': doc_id,
+                                                 'created': created}
+            if method == 'DELETE':
+                found = self.delete_document(index, doc_type, doc_id)
+                return 200 if found else 404, {'_index': index, '_type': doc_type, '_id': doc_id, 'found': found}
+            if method == 'GET':
+                with self._lock:
+                    source = self._indices.get(index, {}).get(doc_type, {}).get(doc_id)
+                if source is None:
+                    return 404, {'_index': index, '_type': doc_type, '_id': doc_id, 'found': False}
+                return 200, {'_index': index, '_type': doc_type, '_id': doc_id, 'found': True, '_source': source}
+        return 400, {'error': {'type': 'illegal_argument_exception', 'reason': 'unsupported request'},
+                     'status': 400}
+
+    def _search(self, index_expr, type_expr, query_params, json_body):
+        hits, aggregations = self.search(index_expr, type_expr, json_body)
+        size = int(query_params.get('size', json_body.get('size', 10)))
+        if 'scroll' in query_params:
+            scroll_id = 'scroll{}'.format(next(self._ids))
+            with self._lock:
+                self._scrolls[scroll_id] = (hits, size)
+            return self._scroll(scroll_id, len(hits))
+        response = {'took': 1, 'timed_out': False, '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                    'hits': {'total': len(hits), 'max_score': 1.0, 'hits': hits[:size]}}
+        if aggregations:
+            response['aggregations'] = aggregations
+        return 200, response
+
+    def _scroll(self, scroll_id, total):
+        with self._lock:
+            if scroll_id not in self._scrolls:
+                return 404, {'error': {'type': 'search_context_missing_exception'}, 'status': 404}
+            hits, size = self._scrolls[scroll_id]
+            self._scrolls[scroll_id] = (hits[size:], size)
+        return 200, {'_scroll_id': scroll_id, 'took': 1, 'timed_out': False,
+                     'hits': {'total': total if total is not None else len(hits), 'hits': hits[:size]}}
+
+    def _bulk(self, body):
+        lines = [line for line in body.splitlines() if line.strip()]
+        items = []
+        position = 0
+        while position < len(lines):
+            action_type, meta = json.loads(lines[position]).items()[0]
+            position += 1
+            index, doc_type, doc_id = meta.get('_index'), meta.get('_type'), meta.get('_id')
+            with self._lock:
+                rejected = self.item_reject_rate > 0 and self._random.random() < self.item_reject_rate
+                if rejected:
+                    self.stats['throttled'] += 1
+            if rejected:
+                if action_type != 'delete':
+                    # skip the source line
+                    position += 1
+                items.append({action_type: {'_index': index, '_type': doc_type, '_id': doc_id, 'status': 429,
+                                            'error': {'type': 'es_rejected_execution_exception',
+                                                      'reason': 'injected rejection'}}})
+            elif action_type in ('index', 'create'):
+                source = json.loads(lines[position])
+                position += 1
+                doc_id, created = self.index_document(index, doc_type, doc_id, source)
+                items.append({action_type: {'_index': index, '_type': doc_type, '_id': doc_id,
+                                            'status': 201 if created else 200}})
+            elif action_type == 'delete':
+                found = self.delete_document(index, doc_type, doc_id)
+                items.append({'delete': {'_index': index, '_type': doc_type, '_id': doc_id,
+                                         'status': 200 if found else 404, 'found': found}})
+            else:
+                position += 1
+                items.append({action_type: {'_index': index, '_type': doc_type, '_id': doc_id, 'status': 400,
+                                            'error': {'type': 'illegal_argument_exception',
+                                                      'reason': 'unsupported bulk action'}}})
+        return 200, {'took': 1, 'errors': any('error' in item.values()[0] for item in items), 'items': items}
+
+    def _create_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # write the response in one piece, separately sent header lines stall keep-alive clients on delayed acks
+            wbufsize = -1
+
+            def _handle(self):
+                url = urlparse.urlparse(self.path)
+                query_params = dict(urlparse.parse_qsl(url.query))
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                status, response = fake.handle(self.command, url.path, query_params, body)
+                data = json.dumps(response)
+                with fake._lock:
+                    fake.stats['bytes_sent'] += len(data)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local elasticsearch stand-in for load and benchmark testing')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on, defaults to 127.0.0.1')
+    parser.add_argument('--port', default=9200, type=int,
+                        help='port to listen on, defaults to 9200')
+    parser.add_argument('--latency', default=0, type=float,
+                        help='seconds added to every response, defaults to 0')
+    parser.add_argument('--error-rate', default=0, type=float,
+                        help='probability of answering 500, defaults to 0')
+    parser.add_argument('--throttle-rate', default=0, type=float,
+                        help='probability of answering 429, defaults to 0')
+    parser.add_argument('--max-requests-per-second', type=int,
+                        help='answer 429 to requests above this rate')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='seed of the error and throttle injection, defaults to 0')
+    parser.add_argument('--item-reject-rate', default=0, type=float,
+                        help='probability of rejecting a single _bulk item, defaults to 0')
+    args = parser.parse_args()
+
+    fake_elasticsearch = FakeElasticsearch(args.host, args.port, args.latency, args.error_rate, args.throttle_rate,
+                                           args.max_requests_per_second, args.seed, args.item_reject_rate)
+    print 'fake elasticsearch listening on {}'.format(fake_elasticsearch.url)
+    try:
+        fake_elasticsearch._server.serve_forever()
+    except KeyboardInterrupt:
+        fake_elasticsearch.stop()
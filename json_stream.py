@@ -0,0 +1,126 @@
+"""
+Incremental decoding of json documents too large to be loaded at once
+
+    for test_result in json_stream.JsonStreamReader(open('results.json')).iter_array('test_results'):
+        ...
+"""
+import json
+import re
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+# a number cut at a chunk boundary may leave up to this many characters undecoded, e.g. '1.5e-' decodes as 1.5
+_max_number_tail = 2
+
+
+class JsonStreamReader(object):
+    def __init__(self, fobj, chunk_size=1 << 16):
+        """
+        Incremental reader of one large json document, only the value being decoded is kept in memory
+
+        :param fobj: file object to read from
+        :param chunk_size: minimal number of characters read at once
+        """
+        self._fobj = fobj
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        # read at least as much as is buffered, so that decoding of a large value is retried O(log n) times
+        chunk = self._fobj.read(max(self._chunk_size, len(self._buffer) - self._pos))
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _next_char(self):
+        while True:
+            self._pos = _whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of json input')
+
+    def _expect(self, expected_chars):
+        char = self._next_char()
+        if char not in expected_chars:
+            raise ValueError("Expected one of '{}' but found '{}'".format(expected_chars, char))
+        self._pos += 1
+        return char
+
+    def _decode_value(self):
+        self._next_char()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            if len(self._buffer) - end <= _max_number_tail and not self._eof and self._fill():
+                # a number could continue in the next chunk
+                continue
+            self._pos = end
+            return value
+
+    def peek(self):
+        """
+        :return: the next non whitespace character
+        """
+        return self._next_char()
+
+    def _iter_array(self):
+        self._expect('[')
+        if self._next_char() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._decode_value()
+            if self._expect(',]') == ']':
+                return
+
+    def iter_values(self):
+        """
+        Yield consecutive top level json values, e.g. the lines of a json lines file, one at a time
+        """
+        while True:
+            try:
+                self._next_char()
+            except ValueError:
+                # end of input
+                return
+            yield self._decode_value()
+
+    def iter_array(self, key=None):
+        """
+        Yield elements of the array under key of the top level json object one at a time,
+        other top level values are decoded and discarded. Without key the top level value is the array
+        """
+        if key is None:
+            for element in self._iter_array():
+                yield element
+            return
+
+        found = False
+        self._expect('{')
+        if self._next_char() == '}':
+            self._pos += 1
+        else:
+            while True:
+                name = self._decode_value()
+                self._expect(':')
+                if name == key:
+                    found = True
+                    for element in self._iter_array():
+                        yield element
+                else:
+                    self._decode_value()
+                if self._expect(',}') == '}':
+                    break
+
+        if not found:
+            raise KeyError(key)
@@ -1,22 +1,22 @@
 #! /usr/bin/env python
-import logging
+import logging_utils
 import argparse
 import shared_utils
+import profiling
 import json
 import urlparse
 
-logger = logging.getLogger('clear_kibana')
-logger.setLevel(logging.DEBUG)
-file_handler = logging.FileHandler('/var/log/{}.log'.format(__name__))
-file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-logger.addHandler(file_handler)
+_log_path = '/var/log/kibana_cleanup.log'
+logger = logging_utils.get_logger('clear_kibana', _log_path)
 
 
 def delete_all(url, es_user, es_passwd):
-    ids = shared_utils.get_elastic_data(url, es_user, es_passwd, body=None, field='_id')
+    with profiling.span('read'):
+        ids = shared_utils.get_elastic_data(url, es_user, es_passwd, body=None, field='_id')
     for id in ids:
         del_url = '/'.join([url, id])
-        shared_utils.delete_request(del_url, es_user, es_passwd)
+        with profiling.span('publish'):
+            shared_utils.delete_request(del_url, es_user, es_passwd)
 
 
 if __name__ == '__main__':
@@ -30,7 +30,12 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--elasticsearch-password',
                         help='the password for elasticsearch')
 
+    parser.add_argument('--profile', action='store_true',
+                        help='write cProfile stats, stage timings and peak memory as json next to the log')
+
     args = parser.parse_args()
+    if args.profile:
+        profiling.start(_log_path)
     base_elastic_url = args.elasticsearch_url
     es_user = args.elasticsearch_username
     es_passwd = args.elasticsearch_password
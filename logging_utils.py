@@ -0,0 +1,133 @@
+import Queue
+import atexit
+import logging
+import threading
+import time
+
+_log_format = '%(asctime)s %(levelname)s: %(message)s'
+
+
+class QueueHandler(logging.Handler):
+    def __init__(self, create_handlers):
+        """
+        Hand records over to a background thread which writes them with the handlers returned by create_handlers,
+        so that logging never waits for the disk. The thread and the handlers are created by the first record
+
+        :param create_handlers: function returning the list of target handlers
+        """
+        logging.Handler.__init__(self)
+        self._create_handlers = create_handlers
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._handlers = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._handlers = self._create_handlers()
+                thread = threading.Thread(target=self._write)
+                # a stuck disk must not keep the process alive, records are drained by close at exit
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                for handler in self._handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                self._queue.task_done()
+
+    def _prepare(self, record):
+        # the arguments may be changed by the caller before the record is written, so render them now
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            if self._thread is None:
+                self._start()
+            self._queue.put(self._prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """
+        Wait until the records logged so far are written
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+            for handler in self._handlers:
+                handler.flush()
+
+    def close(self):
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+            for handler in self._handlers:
+                handler.close()
+        logging.Handler.close(self)
+
+
+def _create_file_handler(log_path):
+    # the file is only opened by the first write
+    file_handler = logging.FileHandler(log_path, delay=True)
+    file_handler.setFormatter(logging.Formatter(_log_format))
+    return file_handler
+
+
+def get_logger(name, log_path):
+    """
+    Logger writing to log_path through a QueueHandler, neither the file nor the writer thread exist before
+    the first record. Records left in the queue are written by logging.shutdown at exit
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    if not any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+        logger.addHandler(QueueHandler(lambda: [_create_file_handler(log_path)]))
+    return logger
+
+
+class MessageCounter(object):
+    def __init__(self, logger, template='skipped {count} {message}', interval=60, level=logging.INFO):
+        """
+        Count repeated messages instead of logging every occurrence. The counts are logged with template
+        at most every interval seconds and at exit, e.g. 'skipped 10432 vIMS results: no sig_test'
+        """
+        self.logger = logger
+        self.template = template
+        self.interval = interval
+        self.level = level
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._last_flush = None
+
+    def add(self, message):
+        with self._lock:
+            if self._last_flush is None:
+                # flushed before logging.shutdown, which was registered at import of logging
+                atexit.register(self.flush)
+                self._last_flush = time.time()
+            self._counts[message] = self._counts.get(message, 0) + 1
+            due = time.time() - self._last_flush >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            self._last_flush = time.time()
+        for message, count in sorted(counts.iteritems()):
+            self.logger.log(self.level, self.template.format(count=count, message=message))
@@ -0,0 +1,171 @@
+import datetime
+import json
+import logging
+import re
+import select
+import socket
+import time
+
+_date_pattern = re.compile(r'(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})(?:\.(\d+))?\s*(Z|([+-])(\d{2}):?(\d{2}))?\s*$')
+
+# the split results of one test result share its creation_date, so most lookups are hits
+_timestamps = {}
+_max_timestamps = 10000
+
+
+def parse_address(address):
+    """
+    :param address: 'host:port'
+    :return: tuple (host, port)
+    """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def to_timestamp(date):
+    """
+    Normalize a mongo creation_date into an utc elasticsearch timestamp with milliseconds:
+        '2016-05-03 12:34:56.123456' -> '2016-05-03T12:34:56.123Z'
+        '2016-05-03T14:34:56.123+02:00' -> '2016-05-03T12:34:56.123Z'
+        {'$date': '2016-05-03T12:34:56.123Z'} -> '2016-05-03T12:34:56.123Z'
+        {'$date': 1462278896123} -> '2016-05-03T12:34:56.123Z'
+    Dates without offset are taken as utc, unknown forms raise ValueError
+    """
+    if isinstance(date, dict):
+        date = date['$date']
+        if isinstance(date, dict):
+            date = int(date['$numberLong'])
+    if isinstance(date, (int, long, float)):
+        return datetime.datetime.utcfromtimestamp(date / 1000.0).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    try:
+        return _timestamps[date]
+    except KeyError:
+        match = _date_pattern.match(date)
+        if match is None:
+            raise ValueError("Unknown date format '{}'".format(date))
+        day, time_of_day, fraction, _, sign, offset_hours, offset_minutes = match.groups()
+        if sign is not None:
+            offset = datetime.timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+            utc = datetime.datetime.strptime('{}T{}'.format(day, time_of_day), '%Y-%m-%dT%H:%M:%S')
+            utc = utc - offset if sign == '+' else utc + offset
+            day, time_of_day = utc.strftime('%Y-%m-%d'), utc.strftime('%H:%M:%S')
+        timestamp = '{}T{}.{}Z'.format(day, time_of_day, (fraction or '')[:3].ljust(3, '0'))
+        if len(_timestamps) >= _max_timestamps:
+            _timestamps.clear()
+        _timestamps[date] = timestamp
+        return timestamp
+
+
+def add_timestamp(document, date_field='creation_date'):
+    """
+    Set @timestamp of document from date_field, so that logstash needs neither a json nor a date filter
+    """
+    date = document.get(date_field)
+    if date is not None:
+        try:
+            document['@timestamp'] = to_timestamp(date)
+        except ValueError:
+            # logstash falls back to the time of ingestion
+            logging.warning("Unknown {} format '{}'".format(date_field, date))
+    return document
+
+
+class JsonLinesTcpSink(object):
+    def __init__(self, host, port, batch_bytes=1 << 16, connect_timeout=10, max_retries=None, retry_delay=1,
+                 max_retry_delay=30):
+        """
+        Stream newline delimited json over a persistent connection to a logstash tcp input with json_lines codec
+
+        Lines are sent in batches of about batch_bytes. Sending blocks while the socket buffer is full, which
+        slows down the producer instead of buffering in memory. A connection closed by logstash is replaced before
+        the next batch. On connection failure the batch is resent over a new connection with exponential backoff,
+        so lines may be delivered more than once
+
+        :param max_retries: number of reconnection attempts per batch, None means retry forever
+        """
+        self.host = host
+        self.port = port
+        self.batch_bytes = batch_bytes
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._socket = None
+        self._batch = []
+        self._batch_size = 0
+
+    def _connect(self):
+        self._socket = socket.create_connection((self.host, self.port), self.connect_timeout)
+        # block on send, this is the backpressure
+        self._socket.settimeout(None)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def _disconnect(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            finally:
+                self._socket = None
+
+    def _peer_closed(self):
+        # logstash never writes to the connection, a readable socket was closed or reset by the other end
+        readable, _, _ = select.select([self._socket], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self._socket.recv(1, socket.MSG_PEEK) == ''
+        except socket.error:
+            return True
+
+    def _send(self, data):
+        attempt = 0
+        while True:
+            try:
+                if self._socket is not None and self._peer_closed():
+                    # sendall into a closed connection succeeds once and loses the data
+                    self._disconnect()
+                if self._socket is None:
+                    self._connect()
+                self._socket.sendall(data)
+                return
+            except socket.error as error:
+                self._disconnect()
+                attempt += 1
+                if self.max_retries is not None and attempt > self.max_retries:
+                    raise
+                delay = min(self.retry_delay * 2 ** (attempt - 1), self.max_retry_delay)
+                logging.warning("Sending to logstash {}:{} failed ({}), reconnecting in {}s".format(self.host,
+                                                                                                  self.port,
+                                                                                                  error,
+                                                                                                  delay))
+                time.sleep(delay)
+
+    def write_line(self, line):
+        self._batch.append(line)
+        self._batch_size += len(line) + 1
+        if self._batch_size >= self.batch_bytes:
+            self.flush()
+
+    def write(self, json_obj):
+        # serialize right away, the caller may modify json_obj afterwards
+        self.write_line(json.dumps(json_obj))
+
+    def flush(self):
+        if self._batch:
+            data = '\n'.join(self._batch) + '\n'
+            self._batch = []
+            self._batch_size = 0
+            self._send(data)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,19 +1,65 @@
 #! /usr/bin/env python
-import logging
+import logging_utils
 import argparse
 import shared_utils
+import logstash_utils
+import pipeline
+import profiling
 import json
 import urlparse
-import uuid
-import os
 import subprocess
 import datetime
-
-logger = logging.getLogger('mongo_to_elasticsearch')
-logger.setLevel(logging.DEBUG)
-file_handler = logging.FileHandler('/var/log/{}.log'.format(__name__))
-file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-logger.addHandler(file_handler)
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+_log_path = '/var/log/mongo_to_elasticsearch.log'
+logger = logging_utils.get_logger('mongo_to_elasticsearch', _log_path)
+
+# skipped test results are counted instead of logged one by one
+skip_counts = logging_utils.MessageCounter(logger)
+
+_index_alias = 'test_results'
+_document_type = 'mongo2elastic'
+
+# strftime formats of the index name suffixes
+_index_partitions = {
+    'daily': '%Y.%m.%d',
+    'monthly': '%Y.%m'
+}
+
+# the keyword sub-field is what dynamic mapping adds to strings, aggregations on '<field>.keyword' work on both
+_keyword_mapping = {'type': 'keyword', 'fields': {'keyword': {'type': 'keyword'}}}
+
+# only these details are indexed, the rest of details is kept in _source
+_details_mapping = {
+    'duration': {'type': 'float'},
+    'tests': {'type': 'long'},
+    'failures': {'type': 'long'},
+    'success_percentage': {'type': 'float'},
+    'FUNCvirNet': {'properties': {'duration': {'type': 'float'},
+                                  'tests': {'type': 'long'},
+                                  'failures': {'type': 'long'}}},
+    'FUNCvirNetL3': {'properties': {'duration': {'type': 'float'},
+                                    'tests': {'type': 'long'},
+                                    'failures': {'type': 'long'}}},
+    'sig_test': {'properties': {'duration': {'type': 'float'},
+                                'tests': {'type': 'long'},
+                                'failures': {'type': 'long'},
+                                'passed': {'type': 'long'},
+                                'skipped': {'type': 'long'}}},
+    'vIMS': {'properties': {'duration': {'type': 'float'}}},
+    'orchestrator': {'properties': {'duration': {'type': 'float'}}}
+}
+
+# set to one of _index_partitions to route test results into time partitioned indices
+index_partition = None
+
+# exact keys of the list entries counted for ODL, vIMS and ONOS, by the modify_functest_* functions
+# as well as by their _aggregation_pipelines
+_odl_status_keys = {'test_status', 'test_doc', 'test_name'}
+_vims_result_keys = {'duration', 'result', 'name', 'error'}
+_onos_status_keys = {'Case result', 'Case name:'}
 
 
 def _get_dicts_from_list(dict_list, keys):
@@ -86,10 +132,9 @@ def modify_functest_vims(testcase):
         -> details.orchestrator.duration
     """
     testcase_details = testcase['details']
-    sig_test_results = _get_dicts_from_list(testcase_details['sig_test']['result'],
-                                            {'duration', 'result', 'name', 'error'})
+    sig_test_results = _get_dicts_from_list(testcase_details['sig_test']['result'], _vims_result_keys)
     if len(sig_test_results) < 1:
-        logger.info("No 'result' from 'sig_test' found in vIMS details, skipping")
+        skip_counts.add("vIMS results: no 'result' in 'sig_test' details")
         return False
     else:
         test_results = _get_results_from_list_of_dicts(sig_test_results, ('result',), ('Passed', 'Skipped', 'Failed'))
@@ -134,16 +179,16 @@ def modify_functest_onos(testcase):
     testcase_details = testcase['details']
 
     funcvirnet_details = testcase_details['FUNCvirNet']['status']
-    funcvirnet_statuses = _get_dicts_from_list(funcvirnet_details, {'Case result', 'Case name:'})
+    funcvirnet_statuses = _get_dicts_from_list(funcvirnet_details, _onos_status_keys)
 
     funcvirnetl3_details = testcase_details['FUNCvirNetL3']['status']
-    funcvirnetl3_statuses = _get_dicts_from_list(funcvirnetl3_details, {'Case result', 'Case name:'})
+    funcvirnetl3_statuses = _get_dicts_from_list(funcvirnetl3_details, _onos_status_keys)
 
     if len(funcvirnet_statuses) < 0:
-        logger.info("No results found in 'FUNCvirNet' part of ONOS results")
+        skip_counts.add("ONOS results: no results in 'FUNCvirNet' details")
         return False
     elif len(funcvirnetl3_statuses) < 0:
-        logger.info("No results found in 'FUNCvirNetL3' part of ONOS results")
+        skip_counts.add("ONOS results: no results in 'FUNCvirNetL3' details")
         return False
     else:
         funcvirnet_results = _get_results_from_list_of_dicts(funcvirnet_statuses,
@@ -159,13 +204,14 @@ def modify_functest_onos(testcase):
         funcvirnetl3_failed = funcvirnetl3_results['FAIL']
         funcvirnetl3_all = funcvirnetl3_passed + funcvirnetl3_failed
 
-        testcase_details['FUNCvirNet'] = {
+        testcase['details'] = dict(testcase_details)
+        testcase['details']['FUNCvirNet'] = {
             'duration': _convert_duration(testcase_details['FUNCvirNet']['duration']),
             'tests': funcvirnet_all,
             'failures': funcvirnet_failed
         }
 
-        testcase_details['FUNCvirNetL3'] = {
+        testcase['details']['FUNCvirNetL3'] = {
             'duration': _convert_duration(testcase_details['FUNCvirNetL3']['duration']),
             'tests': funcvirnetl3_all,
             'failures': funcvirnetl3_failed
@@ -189,7 +235,7 @@ def modify_functest_rally(testcase):
     summaries = _get_dicts_from_list(testcase['details'], {'summary'})
 
     if len(summaries) != 1:
-        logger.info("Found zero or more than one 'summaries' in Rally details, skipping")
+        skip_counts.add("Rally results: zero or more than one 'summary' in details")
         return False
     else:
         summary = summaries[0]['summary']
@@ -211,9 +257,9 @@ def modify_functest_odl(testcase):
         -> details.failures
         -> details.success_percentage?
     """
-    test_statuses = _get_dicts_from_list(testcase['details']['details'], {'test_status', 'test_doc', 'test_name'})
+    test_statuses = _get_dicts_from_list(testcase['details']['details'], _odl_status_keys)
     if len(test_statuses) < 1:
-        logger.info("No 'test_status' found in ODL details, skipping")
+        skip_counts.add("ODL results: no 'test_status' in details")
         return False
     else:
         test_results = _get_results_from_list_of_dicts(test_statuses, ('test_status', '@status'), ('PASS', 'FAIL'))
@@ -243,24 +289,82 @@ def modify_default_entry(testcase):
     testcase_details = testcase['details']
     fields = ['duration', 'tests', 'failures']
     if isinstance(testcase_details, dict):
-        for key, value in testcase_details.items():
+        testcase['details'] = {}
+        for key, value in testcase_details.iteritems():
             if key in fields:
                 found = True
-                if key == 'duration':
-                    testcase_details[key] = _convert_duration(value)
-            else:
-                del testcase_details[key]
+                testcase['details'][key] = _convert_duration(value) if key == 'duration' else value
 
     return found
 
 
 def _fix_date(date_string):
-    if isinstance(date_string, dict):
-        return date_string['$date']
-    else:
+    try:
+        return logstash_utils.to_timestamp(date_string)
+    except ValueError:
         return date_string[:-3].replace(' ', 'T') + 'Z'
 
 
+class MongoEntrySchema(object):
+    def __init__(self, mandatory, transformed=None, optional=(), drop=(), keep_unknown=False):
+        """
+        Compile a declarative schema once, then validate and project testcases with project()
+
+        :param mandatory: fields which must be present and must NOT be None
+        :param transformed: mandatory fields mapped to a function applied to their value, e.g. _fix_date
+        :param optional: fields which are preserved if they are NOT None
+        :param drop: fields which are always removed
+        :param keep_unknown: preserve fields not mentioned in the schema, only drop fields are removed then
+        """
+        self._transformed = dict(transformed or {})
+        self._mandatory = frozenset(mandatory) | frozenset(self._transformed)
+        self._optional = frozenset(optional)
+        self._drop = frozenset(drop)
+        self._keep_unknown = keep_unknown
+
+    def project(self, testcase):
+        """
+        Build a new dict from testcase in one pass, the input is left untouched. Nested values like details are
+        shared with the input, so the modify_* functions replace them instead of changing them in place
+
+        :return: the projected testcase or None if a mandatory field is missing or None
+        """
+        projected = {}
+        nr_of_mandatory = 0
+        for key, value in testcase.iteritems():
+            if key in self._mandatory:
+                if value is None:
+                    # empty mandatory field, invalid input
+                    skip_counts.add("testcases: no value for mandatory field '{}'".format(key))
+                    return None
+                transform = self._transformed.get(key)
+                projected[key] = value if transform is None else transform(value)
+                nr_of_mandatory += 1
+            elif key in self._optional:
+                if value is not None:
+                    projected[key] = value
+            elif self._keep_unknown and key not in self._drop:
+                projected[key] = value
+
+        if nr_of_mandatory < len(self._mandatory):
+            # some mandatory fields are missing
+            skip_counts.add("testcases: missing mandatory field(s) {}".format(
+                sorted(self._mandatory.difference(projected))))
+            return None
+        return projected
+
+
+_mongo_entry_schema = MongoEntrySchema(mandatory=('installer',
+                                                  'pod_name',
+                                                  'version',
+                                                  'case_name',
+                                                  'project_name',
+                                                  'details'),
+                                       transformed={'creation_date': _fix_date},
+                                       optional=('description',),
+                                       drop=('_id',))
+
+
 def verify_mongo_entry(testcase):
     """
     Mandatory fields:
@@ -268,8 +372,8 @@ def verify_mongo_entry(testcase):
         pod_name
         version
         case_name
-        date
-        project
+        creation_date
+        project_name
         details
 
         these fields must be present and must NOT be None
@@ -278,106 +382,330 @@ def verify_mongo_entry(testcase):
         description
 
         these fields will be preserved if the are NOT None
-    """
-    mandatory_fields = ['installer',
-                        'pod_name',
-                        'version',
-                        'case_name',
-                        'project_name',
-                        'details']
-    mandatory_fields_to_modify = {'creation_date': _fix_date}
-    if '_id' in testcase:
-        mongo_id = testcase['_id']
-    else:
-        mongo_id = None
-    optional_fields = ['description']
-    for key, value in testcase.items():
-        if key in mandatory_fields:
-            if value is None:
-                # empty mandatory field, invalid input
-                logger.info("Skipping testcase with mongo _id '{}' because the testcase was missing value"
-                            " for mandatory field '{}'".format(mongo_id, key))
-                return False
-            else:
-                mandatory_fields.remove(key)
-        elif key in mandatory_fields_to_modify:
-            if value is None:
-                # empty mandatory field, invalid input
-                logger.info("Skipping testcase with mongo _id '{}' because the testcase was missing value"
-                            " for mandatory field '{}'".format(mongo_id, key))
-                return False
-            else:
-                testcase[key] = mandatory_fields_to_modify[key](value)
-                del mandatory_fields_to_modify[key]
-        elif key in optional_fields:
-            if value is None:
-                # empty optional field, remove
-                del testcase[key]
-            optional_fields.remove(key)
-        else:
-            # unknown field
-            del testcase[key]
 
-    if len(mandatory_fields) > 0:
-        # some mandatory fields are missing
-        logger.info("Skipping testcase with mongo _id '{}' because the testcase was missing"
-                    " mandatory field(s) '{}'".format(mongo_id, mandatory_fields))
-        return False
-    else:
-        return True
+    :return: new testcase with only the above fields or None if the testcase is invalid
+    """
+    return _mongo_entry_schema.project(testcase)
 
 
 def modify_mongo_entry(testcase):
     # 1. verify and identify the testcase
     # 2. if modification is implemented, then use that
     # 3. if not, try to use default
-    # 4. if 2 or 3 is successful, return True, otherwise return False
-    if verify_mongo_entry(testcase):
-        project = testcase['project_name']
-        case_name = testcase['case_name']
-        if project == 'functest':
-            if case_name == 'Rally':
-                return modify_functest_rally(testcase)
-            elif case_name == 'ODL':
-                return modify_functest_odl(testcase)
-            elif case_name == 'ONOS':
-                return modify_functest_onos(testcase)
-            elif case_name == 'vIMS':
-                return modify_functest_vims(testcase)
-            elif case_name == 'Tempest':
-                return modify_functest_tempest(testcase)
-        return modify_default_entry(testcase)
-    else:
-        return False
+    # 4. if 2 or 3 is successful, return the modified testcase, otherwise return None
+    testcase = verify_mongo_entry(testcase)
+    if testcase is None:
+        return None
 
+    project = testcase['project_name']
+    case_name = testcase['case_name']
+    modify = modify_default_entry
+    if project == 'functest':
+        if case_name == 'Rally':
+            modify = modify_functest_rally
+        elif case_name == 'ODL':
+            modify = modify_functest_odl
+        elif case_name == 'ONOS':
+            modify = modify_functest_onos
+        elif case_name == 'vIMS':
+            modify = modify_functest_vims
+        elif case_name == 'Tempest':
+            modify = modify_functest_tempest
+    return testcase if modify(testcase) else None
 
-def publish_mongo_data(output_destination):
-    tmp_filename = 'mongo-{}.log'.format(uuid.uuid4())
-    try:
-        subprocess.check_call(['mongoexport', '--db', 'test_results_collection', '-c', 'test_results', '--out',
-                               tmp_filename])
-        with open(tmp_filename) as fobj:
-            for mongo_json_line in fobj:
-                test_result = json.loads(mongo_json_line)
-                if modify_mongo_entry(test_result):
-                    shared_utils.publish_json(test_result, output_destination, es_user, es_passwd)
-    finally:
-        if os.path.exists(tmp_filename):
-            os.remove(tmp_filename)
-
-
-def get_mongo_data(days):
-    past_time = datetime.datetime.today() - datetime.timedelta(days=days)
-    mongo_json_lines = subprocess.check_output(['mongoexport', '--db', 'test_results_collection', '-c', 'test_results',
-                                                '--query', '{{"creation_date":{{$gt:"{}"}}}}'
-                                               .format(past_time)]).splitlines()
-
-    mongo_data = []
-    for mongo_json_line in mongo_json_lines:
-        test_result = json.loads(mongo_json_line)
-        if modify_mongo_entry(test_result):
-            # if the modification could be applied, append the modified result
-            mongo_data.append(test_result)
+
+_aggregated_fields = ('installer', 'pod_name', 'version', 'case_name', 'project_name', 'creation_date', 'description')
+
+# functest case names whose per-test details are counted by mongodb itself in aggregation mode
+_aggregated_case_names = ('ODL', 'vIMS', 'ONOS')
+
+
+def _creation_date_range(since=None, until=None):
+    date_range = {}
+    if since is not None:
+        date_range['$gt'] = str(since)
+    if until is not None:
+        date_range['$lte'] = str(until)
+    return date_range
+
+
+def _aggregation_match(case_name, since, until):
+    match = {'project_name': 'functest', 'case_name': case_name}
+    if since is not None or until is not None:
+        match['creation_date'] = _creation_date_range(since, until)
+    return {'$match': match}
+
+
+def _aggregation_group(**accumulators):
+    group = {'_id': '$_id'}
+    for field in _aggregated_fields:
+        group[field] = {'$first': '$' + field}
+    group.update(accumulators)
+    return {'$group': group}
+
+
+def _aggregation_project(details):
+    project = {'_id': 0, 'details': details}
+    for field in _aggregated_fields:
+        project[field] = 1
+    return {'$project': project}
+
+
+def _count_equal(field_path, value):
+    return {'$sum': {'$cond': [{'$eq': [field_path, value]}, 1, 0]}}
+
+
+def _has_keys(object_path, keys):
+    # true if the value at object_path is an object with exactly keys, like the check of _get_dicts_from_list
+    return {'$and': [{'$eq': [{'$type': object_path}, 'object']},
+                     {'$setEquals': [{'$map': {'input': {'$objectToArray': object_path}, 'as': 'field',
+                                               'in': '$$field.k'}},
+                                     sorted(keys)]}]}
+
+
+def _count_list_equal(list_path, keys, field, value):
+    return {'$size': {'$filter': {'input': {'$ifNull': [list_path, []]},
+                                  'as': 'entry',
+                                  'cond': {'$and': [_has_keys('$$entry', keys),
+                                                    {'$eq': ['$$entry.' + field, value]}]}}}}
+
+
+def _functest_odl_pipeline(since=None, until=None):
+    """
+    Counterpart of modify_functest_odl, success_percentage is computed in modify_aggregated_entry
+    """
+    status = '$details.details.test_status.@status'
+    return [
+        _aggregation_match('ODL', since, until),
+        {'$unwind': '$details.details'},
+        {'$match': {'$expr': _has_keys('$details.details', _odl_status_keys)}},
+        _aggregation_group(passed=_count_equal(status, 'PASS'),
+                           failures=_count_equal(status, 'FAIL')),
+        _aggregation_project({'tests': {'$add': ['$passed', '$failures']},
+                              'failures': '$failures',
+                              'passed': '$passed'})
+    ]
+
+
+def _functest_vims_pipeline(since=None, until=None):
+    """
+    Counterpart of modify_functest_vims
+    """
+    result = '$details.sig_test.result.result'
+    return [
+        _aggregation_match('vIMS', since, until),
+        {'$unwind': '$details.sig_test.result'},
+        {'$match': {'$expr': _has_keys('$details.sig_test.result', _vims_result_keys)}},
+        _aggregation_group(passed=_count_equal(result, 'Passed'),
+                           skipped=_count_equal(result, 'Skipped'),
+                           failures=_count_equal(result, 'Failed'),
+                           sig_test_duration={'$first': '$details.sig_test.duration'},
+                           vims_duration={'$first': '$details.vIMS.duration'},
+                           orchestrator_duration={'$first': '$details.orchestrator.duration'}),
+        _aggregation_project({'sig_test': {'duration': '$sig_test_duration',
+                                           'tests': {'$add': ['$passed', '$skipped', '$failures']},
+                                           'failures': '$failures',
+                                           'passed': '$passed',
+                                           'skipped': '$skipped'},
+                              'vIMS': {'duration': '$vims_duration'},
+                              'orchestrator': {'duration': '$orchestrator_duration'}})
+    ]
+
+
+def _functest_onos_pipeline(since=None, until=None):
+    """
+    Counterpart of modify_functest_onos, durations are converted in modify_aggregated_entry
+
+    The two status lists are counted with $filter instead of $unwind, unwinding both would multiply the documents
+    """
+    details = {}
+    for part in ('FUNCvirNet', 'FUNCvirNetL3'):
+        statuses = '$details.{}.status'.format(part)
+        passed = _count_list_equal(statuses, _onos_status_keys, 'Case result', 'PASS')
+        failures = _count_list_equal(statuses, _onos_status_keys, 'Case result', 'FAIL')
+        details[part] = {'duration': '$details.{}.duration'.format(part),
+                         'tests': {'$add': [passed, failures]},
+                         'failures': failures}
+    return [
+        _aggregation_match('ONOS', since, until),
+        _aggregation_project(details)
+    ]
+
+
+_aggregation_pipelines = {
+    'ODL': _functest_odl_pipeline,
+    'vIMS': _functest_vims_pipeline,
+    'ONOS': _functest_onos_pipeline
+}
+
+
+def _run_mongo_aggregation(pipeline):
+    script = 'db.test_results.aggregate({}, {{allowDiskUse: true}}).forEach(function(doc) {{' \
+             ' print(JSON.stringify(doc)); }})'.format(json.dumps(pipeline))
+    return subprocess.check_output(['mongo', '--quiet', 'test_results_collection', '--eval', script]).splitlines()
+
+
+def modify_aggregated_entry(testcase):
+    """
+    Finish a testcase which was already counted by one of the _aggregation_pipelines
+
+    :return: the modified testcase or None if it has to be skipped
+    """
+    testcase = verify_mongo_entry(testcase)
+    if testcase is None:
+        return None
+
+    case_name = testcase['case_name']
+    testcase_details = testcase['details']
+    if case_name == 'ODL':
+        if testcase_details['tests'] < 1:
+            skip_counts.add("ODL results: no 'test_status' in details")
+            return None
+        testcase['details'] = dict((key, value) for key, value in testcase_details.iteritems() if key != 'passed')
+        testcase['details']['success_percentage'] = 100 * testcase_details['passed'] / \
+            float(testcase_details['tests'])
+    elif case_name == 'vIMS':
+        if testcase_details['sig_test']['tests'] < 1:
+            skip_counts.add("vIMS results: no 'result' in 'sig_test' details")
+            return None
+    elif case_name == 'ONOS':
+        testcase['details'] = dict(testcase_details)
+        for part in ('FUNCvirNet', 'FUNCvirNetL3'):
+            testcase['details'][part] = dict(testcase_details[part],
+                                             duration=_convert_duration(testcase_details[part]['duration']))
+    return testcase
+
+
+def get_aggregated_mongo_data(since=None, until=None):
+    aggregated_data = []
+    for case_name in _aggregated_case_names:
+        for mongo_json_line in _run_mongo_aggregation(_aggregation_pipelines[case_name](since, until)):
+            test_result = modify_aggregated_entry(json.loads(mongo_json_line))
+            if test_result is not None:
+                aggregated_data.append(test_result)
+    return aggregated_data
+
+
+def _mongo_query(since=None, until=None, aggregate=False):
+    query = {}
+    if since is not None or until is not None:
+        query['creation_date'] = _creation_date_range(since, until)
+    if aggregate:
+        # these are exported by get_aggregated_mongo_data
+        query['$nor'] = [{'project_name': 'functest', 'case_name': {'$in': list(_aggregated_case_names)}}]
+    return json.dumps(query)
+
+
+def _get_partition_date(creation_date):
+    if isinstance(creation_date, (int, long, float)):
+        # milliseconds since epoch
+        return datetime.datetime.utcfromtimestamp(creation_date / 1000.0)
+    return datetime.datetime.strptime(creation_date[:10], '%Y-%m-%d')
+
+
+def get_output_destination(test_result, output_destination):
+    """
+    With index_partition set, output_destination is a url with a '{}' placeholder for the index suffix
+    """
+    if index_partition is None or output_destination == 'stdout':
+        return output_destination
+    partition_date = _get_partition_date(test_result['creation_date'])
+    return output_destination.format(partition_date.strftime(_index_partitions[index_partition]))
+
+
+def install_index_template(elastic_url, es_user, es_passwd):
+    """
+    Every partitioned index gets explicit mappings and joins the _index_alias alias on creation,
+    so searches against /test_results/mongo2elastic span all partitions
+    """
+    template = {
+        'template': '{}-*'.format(_index_alias),
+        'aliases': {_index_alias: {}},
+        'mappings': {
+            _document_type: {
+                'properties': {
+                    'installer': _keyword_mapping,
+                    'pod_name': _keyword_mapping,
+                    'version': _keyword_mapping,
+                    'case_name': _keyword_mapping,
+                    'project_name': _keyword_mapping,
+                    'description': {'type': 'text'},
+                    'creation_date': {'type': 'date'},
+                    'details': {
+                        'dynamic': False,
+                        'properties': _details_mapping
+                    }
+                }
+            }
+        }
+    }
+    shared_utils.put_json(template, es_user, es_passwd,
+                          urlparse.urljoin(elastic_url, '/_template/{}'.format(_index_alias)))
+
+
+def delete_expired_indices(elastic_url, es_user, es_passwd, retention_days):
+    """
+    Delete whole partitioned indices whose time range is older than retention_days
+    """
+    cutoff = datetime.datetime.today() - datetime.timedelta(days=retention_days)
+    indices = shared_utils.get_json(urlparse.urljoin(elastic_url,
+                                                     '/_cat/indices/{}-*?format=json&h=index'.format(_index_alias)),
+                                    es_user, es_passwd)
+    for index in indices:
+        index_name = index['index']
+        try:
+            index_start = datetime.datetime.strptime(index_name[len(_index_alias) + 1:],
+                                                     _index_partitions[index_partition])
+        except ValueError:
+            # not an index of this partitioning
+            continue
+
+        if index_partition == 'daily':
+            index_end = index_start + datetime.timedelta(days=1)
+        else:
+            index_end = (index_start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+        if index_end <= cutoff:
+            logger.info("deleting expired index '{}'".format(index_name))
+            shared_utils.delete_request(urlparse.urljoin(elastic_url, '/' + index_name), es_user, es_passwd)
+
+
+def _modify_mongo_json_line(mongo_json_line):
+    return modify_mongo_entry(json.loads(mongo_json_line))
+
+
+def _mongoexport_args(since=None, until=None, aggregate=False):
+    return ['mongoexport', '--db', 'test_results_collection', '-c', 'test_results',
+            '--query', _mongo_query(since, until, aggregate)]
+
+
+def publish_mongo_data(output_destination, aggregate=False):
+    """
+    Stream the export of mongoexport through modify_mongo_entry into output_destination
+
+    :return: number of published test results
+    """
+    def publish(test_result):
+        shared_utils.publish_json(test_result, es_user, es_passwd,
+                                  get_output_destination(test_result, output_destination))
+
+    publish = profiling.timed('publish', publish)
+    mongo_json_lines = pipeline.command_lines(_mongoexport_args(aggregate=aggregate))
+    published = pipeline.run(profiling.timed_iter('read', mongo_json_lines),
+                             [pipeline.map_stage(profiling.timed('transform', _modify_mongo_json_line))],
+                             pipeline.for_each(publish))
+    if aggregate:
+        published += pipeline.run(get_aggregated_mongo_data(), [], pipeline.for_each(publish))
+    return published
+
+
+def get_mongo_data(since, until=None, aggregate=False):
+    mongo_json_lines = pipeline.command_lines(_mongoexport_args(since, until, aggregate))
+    mongo_data = pipeline.run(profiling.timed_iter('read', mongo_json_lines),
+                              [pipeline.map_stage(profiling.timed('transform', _modify_mongo_json_line))],
+                              list)
+    if aggregate:
+        mongo_data.extend(get_aggregated_mongo_data(since, until))
     return mongo_data
 
 
@@ -389,7 +717,88 @@ def publish_difference(mongo_data, elastic_data, output_destination, es_user, es
     logger.info('number of parsed test results: {}'.format(len(mongo_data)))
 
     for parsed_test_result in mongo_data:
-        shared_utils.publish_json(parsed_test_result, es_user, es_passwd, output_destination)
+        with profiling.span('publish'):
+            shared_utils.publish_json(parsed_test_result, es_user, es_passwd,
+                                      get_output_destination(parsed_test_result, output_destination))
+
+    return len(mongo_data)
+
+
+def _elastic_range_body(since, until=None):
+    creation_date_range = {'gt': since.strftime('%Y-%m-%dT%H:%M:%S')}
+    if until is not None:
+        creation_date_range['lte'] = until.strftime('%Y-%m-%dT%H:%M:%S')
+    return json.dumps({'query': {'range': {'creation_date': creation_date_range}}})
+
+
+def merge_shard(since, until, output_destination, aggregate, elastic_url, es_user, es_passwd):
+    """
+    Export, transform and publish the test results created in (since, until] which are not in elastic_url yet
+
+    :return: number of published test results
+    """
+    with profiling.span('read'):
+        elastic_data = shared_utils.get_elastic_data(elastic_url, es_user, es_passwd,
+                                                     _elastic_range_body(since, until))
+    mongo_data = get_mongo_data(since, until, aggregate)
+    return publish_difference(mongo_data, elastic_data, output_destination, es_user, es_passwd)
+
+
+def get_shards(since, until, shard_days):
+    """
+    Split (since, until] into consecutive shards shard_days long, the shards after the first one start at midnight
+    so that a shard of a previous run can be rerun with --only-shard
+    """
+    shards = []
+    shard_start = since
+    shard_end = datetime.datetime.combine(since.date(), datetime.time())
+    while shard_start < until:
+        shard_end = min(shard_end + datetime.timedelta(days=shard_days), until)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end
+    return shards
+
+
+def get_only_shard(shard_date, shard_days, until):
+    """
+    :param shard_date: date string YYYY-MM-DD of --only-shard, as logged for failed shards
+    :return: list with the shard of shard_days, at least one day, which starts at midnight of shard_date
+    """
+    shard_start = datetime.datetime.strptime(shard_date, '%Y-%m-%d')
+    return [(shard_start, min(shard_start + datetime.timedelta(days=max(shard_days, 1)), until))]
+
+
+def merge_shards(shards, output_destination, aggregate, elastic_url, es_user, es_passwd, parallelism, retries):
+    """
+    Merge the shards concurrently, each shard is retried on its own
+
+    :return: list of shards which failed after all retries
+    """
+    def merge(shard):
+        since, until = shard
+        for attempt in range(1, retries + 2):
+            start_time = time.time()
+            try:
+                published = merge_shard(since, until, output_destination, aggregate, elastic_url, es_user,
+                                        es_passwd)
+            except Exception:
+                logger.exception("shard '{}' failed, attempt {} of {}".format(since.date(), attempt, retries + 1))
+            else:
+                logger.info("shard '{}' published {} test results in {:.1f}s".format(since.date(), published,
+                                                                                      time.time() - start_time))
+                return None
+        return shard
+
+    pool = ThreadPool(parallelism)
+    try:
+        failed_shards = [shard for shard in pool.imap_unordered(merge, shards) if shard is not None]
+    finally:
+        pool.close()
+        pool.join()
+
+    for since, _ in failed_shards:
+        logger.error("shard '{}' failed, rerun it with --only-shard {}".format(since.date(), since.date()))
+    return failed_shards
 
 
 if __name__ == '__main__':
@@ -413,36 +822,77 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--elasticsearch-password',
                         help='the password for elasticsearch')
 
+    parser.add_argument('-ma', '--mongo-aggregate', action='store_true',
+                        help='count the ODL, vIMS and ONOS test statuses in mongodb aggregation pipelines'
+                             ' instead of exporting all their details, needs mongodb 3.6 or newer')
+
+    parser.add_argument('-sd', '--shard-days', default=0, type=int, metavar='D',
+                        help='split the --merge-latest window into shards of D days which are merged concurrently.'
+                             ' Defaults to 0, which merges the whole window at once')
+
+    parser.add_argument('-pl', '--parallelism', default=4, type=int,
+                        help='number of shards merged at the same time, defaults to 4')
+
+    parser.add_argument('-r', '--retries', default=2, type=int,
+                        help='number of times a failed shard is retried, defaults to 2')
+
+    parser.add_argument('-os', '--only-shard', metavar='YYYY-MM-DD',
+                        help='merge only the shard of --shard-days starting at this date')
+
+    parser.add_argument('-ip', '--index-partition', choices=sorted(_index_partitions),
+                        help='route test results into daily or monthly {0}-<date> indices by creation_date.'
+                             ' The indices are created from an index template and joined under the {0} alias,'
+                             ' so an existing {0} index has to be reindexed into them and removed first'
+                             .format(_index_alias))
+
+    parser.add_argument('-rd', '--retention-days', type=int, metavar='N',
+                        help='with --index-partition, delete the indices older than N days')
+
     parser.add_argument('-m', '--mongodb-url', default='http://localhost:8082',
                         help='the url of mongodb, defaults to http://localhost:8082')
 
+    parser.add_argument('--profile', action='store_true',
+                        help='write cProfile stats, stage timings and peak memory as json next to the log')
+
     args = parser.parse_args()
-    base_elastic_url = urlparse.urljoin(args.elasticsearch_url, '/test_results/mongo2elastic')
+    if args.profile:
+        profiling.start(_log_path)
+    base_elastic_url = urlparse.urljoin(args.elasticsearch_url, '/{}/{}'.format(_index_alias, _document_type))
     output_destination = args.output_destination
     days = args.merge_latest
     es_user = args.elasticsearch_username
     es_passwd = args.elasticsearch_password
+    aggregate = args.mongo_aggregate
+    shard_days = args.shard_days
+    index_partition = args.index_partition
 
     if output_destination == 'elasticsearch':
-        output_destination = base_elastic_url
+        if index_partition is None:
+            output_destination = base_elastic_url
+        else:
+            install_index_template(args.elasticsearch_url, es_user, es_passwd)
+            output_destination = urlparse.urljoin(args.elasticsearch_url,
+                                                  '/{}-{{}}/{}'.format(_index_alias, _document_type))
 
     # parsed_test_results will be printed/sent to elasticsearch
     if days == 0:
         # TODO get everything from mongo
-        publish_mongo_data(output_destination)
+        publish_mongo_data(output_destination, aggregate)
     elif days > 0:
-        body = '''{{
-    "query" : {{
-        "range" : {{
-            "creation_date" : {{
-                "gte" : "now-{}d"
-            }}
-        }}
-    }}
-}}'''.format(days)
-        elastic_data = shared_utils.get_elastic_data(base_elastic_url, es_user, es_passwd, body)
-        logger.info('number of hits in elasticsearch for now-{}d: {}'.format(days, len(elastic_data)))
-        mongo_data = get_mongo_data(days)
-        publish_difference(mongo_data, elastic_data, output_destination, es_user, es_passwd)
+        until = datetime.datetime.today()
+        since = until - datetime.timedelta(days=days)
+        if args.only_shard is not None:
+            shards = get_only_shard(args.only_shard, shard_days, until)
+        elif shard_days > 0:
+            shards = get_shards(since, until, shard_days)
+        else:
+            shards = [(since, until)]
+        logger.info('merging {} shard(s) of the last {} days'.format(len(shards), days))
+        if merge_shards(shards, output_destination, aggregate, base_elastic_url, es_user, es_passwd,
+                        args.parallelism, args.retries):
+            sys.exit(1)
     else:
         raise Exception('Update must be non-negative')
+
+    if index_partition is not None and args.retention_days is not None:
+        delete_expired_indices(args.elasticsearch_url, es_user, es_passwd, args.retention_days)
@@ -2,177 +2,418 @@
 import logging
 import argparse
 import json
-import uuid
-import copy
+import hashlib
+import heapq
+import os
+import sys
+import time
+import functools
+import multiprocessing
+import json_stream
+import logstash_utils
+import pipeline
+import profiling
 
 
 conflicting_fields = {'_id', '_type', '_index', '_score', '_source'}
 
+# key -> renamed key or None if the key is kept, the same few keys repeat in every test result
+_renamed_keys = {}
+_max_renamed_keys = 100000
+
+
+def _get_renamed_key(key):
+    try:
+        return _renamed_keys[key]
+    except KeyError:
+        if key in conflicting_fields:
+            renamed_key = 'mongo' + key
+        elif '.' in key:
+            renamed_key = key.replace('.', ':')
+        else:
+            renamed_key = None
+
+        if len(_renamed_keys) < _max_renamed_keys:
+            _renamed_keys[key] = renamed_key
+        return renamed_key
+
+
+def _new_container(value, stack):
+    # empty copy of a dict or list which is filled when it is popped from stack
+    if isinstance(value, dict):
+        container = {}
+    elif isinstance(value, list):
+        container = []
+    else:
+        return value
+    stack.append((value, container))
+    return container
+
 
 def rename_conflicting_fields(json_obj):
-    if isinstance(json_obj, dict):
-        for key, value in json_obj.items():
-            if key in conflicting_fields:
-                # rename
-                prefix = 'mongo' + key
-                new_key = prefix
-                while new_key in json_obj:
-                    new_key = prefix + str(uuid.uuid4())
-
-                json_obj[new_key] = value
-                del json_obj[key]
-            elif '.' in key:
-                prefix = key.replace('.', ':')
-                new_key = prefix
-                while new_key in json_obj:
-                    new_key = prefix + str(uuid.uuid4())
-
-                json_obj[new_key] = value
-                del json_obj[key]
-
-            rename_conflicting_fields(value)
-    elif isinstance(json_obj, list):
-        for json_section in json_obj:
-            rename_conflicting_fields(json_section)
-
-
-def analyze_testcases(test_results_section):
-    case_names = {}
-    result_types = []
-    result_fields = {}
-    for test_result in test_results_section:
-        case_name = test_result['case_name']
-        if case_name in case_names:
-            case_names[case_name] += 1
+    """
+    Build a copy of json_obj in one pass, where keys conflicting with elasticsearch metadata are prefixed
+    with 'mongo' and dots in keys are replaced by ':'. If the new key is already taken, '_<n>' is appended
+    with the lowest free n, so the output is the same on every run
+    """
+    stack = []
+    renamed_obj = _new_container(json_obj, stack)
+    while stack:
+        source, target = stack.pop()
+        if isinstance(source, dict):
+            for key, value in source.iteritems():
+                new_key = _get_renamed_key(key)
+                if new_key is None:
+                    new_key = key
+                elif new_key in source or new_key in target:
+                    suffix = 1
+                    while '{}_{}'.format(new_key, suffix) in source or '{}_{}'.format(new_key, suffix) in target:
+                        suffix += 1
+                    new_key = '{}_{}'.format(new_key, suffix)
+                target[new_key] = _new_container(value, stack)
         else:
-            case_names[case_name] = 1
-            result_types.append(test_result)
+            for value in source:
+                target.append(_new_container(value, stack))
+    return renamed_obj
+
+
+class DistinctSketch(object):
+    _max_hash = float(1 << 60)
+
+    def __init__(self, k=256):
+        """
+        K minimum values sketch, estimates the number of distinct values from the k smallest value hashes
+
+        :param k: number of kept hashes, the relative error is about 1 / sqrt(k)
+        """
+        self._k = k
+        self._heap = []
+        self._hashes = set()
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value_hash = int(hashlib.md5(str(value)).hexdigest()[:15], 16)
+        if value_hash in self._hashes:
+            return
+        if len(self._heap) < self._k:
+            # max heap of the k smallest hashes
+            heapq.heappush(self._heap, -value_hash)
+            self._hashes.add(value_hash)
+        elif value_hash < -self._heap[0]:
+            self._hashes.discard(-heapq.heapreplace(self._heap, -value_hash))
+            self._hashes.add(value_hash)
+
+    def estimate(self):
+        if len(self._heap) < self._k:
+            return len(self._heap)
+        return int((self._k - 1) * self._max_hash / -self._heap[0])
 
-    for test_result in result_types:
-        for field in test_result.iterkeys():
-            if field in result_fields:
-                result_fields[field] += 1
+
+def _get_type_name(value):
+    if isinstance(value, dict):
+        return 'object'
+    elif isinstance(value, list):
+        return 'array'
+    elif isinstance(value, basestring):
+        return 'string'
+    elif isinstance(value, bool):
+        return 'boolean'
+    elif isinstance(value, (int, long)):
+        return 'integer'
+    elif isinstance(value, float):
+        return 'float'
+    return 'null'
+
+
+class SchemaProfiler(object):
+    def __init__(self, max_depth=4, max_list_items=10, max_fields=500, max_cases=1000, sketch_size=256):
+        """
+        Streaming profile of test results per case_name: document counts, field presence rates,
+        value type distributions and approximate distinct value counts. Every test result is looked at once
+        and memory is bounded by the limits below regardless of the number of test results
+
+        :param max_depth: nesting depth up to which fields are profiled
+        :param max_list_items: number of list entries profiled in each list, entries are profiled as '<field>[]'
+        :param max_fields: number of profiled fields per case name, further fields are only counted
+        :param max_cases: number of profiled case names, further case names are only counted
+        :param sketch_size: size of the distinct value sketch of each field
+        """
+        self.max_depth = max_depth
+        self.max_list_items = max_list_items
+        self.max_fields = max_fields
+        self.max_cases = max_cases
+        self.sketch_size = sketch_size
+        self.nr_of_test_results = 0
+        self.nr_of_unprofiled = 0
+        self._cases = {}
+
+    def _get_case(self, case_name):
+        case = self._cases.get(case_name)
+        if case is None and len(self._cases) < self.max_cases:
+            case = self._cases[case_name] = {'count': 0, 'fields': {}, 'untracked_fields': 0}
+        return case
+
+    def _get_field(self, case, path):
+        field = case['fields'].get(path)
+        if field is None:
+            if len(case['fields']) >= self.max_fields:
+                case['untracked_fields'] += 1
+                return None
+            field = case['fields'][path] = {'present': 0, 'types': {}, 'distinct': DistinctSketch(self.sketch_size)}
+        return field
+
+    def update(self, test_result):
+        self.nr_of_test_results += 1
+        case = self._get_case(test_result.get('case_name'))
+        if case is None:
+            self.nr_of_unprofiled += 1
+            return
+        case['count'] += 1
+
+        present = set()
+        stack = [(key, value, 1) for key, value in test_result.iteritems()]
+        while stack:
+            path, value, depth = stack.pop()
+            field = self._get_field(case, path)
+            if field is None:
+                continue
+            if path not in present:
+                present.add(path)
+                field['present'] += 1
+            type_name = _get_type_name(value)
+            field['types'][type_name] = field['types'].get(type_name, 0) + 1
+            if type_name == 'object':
+                if depth < self.max_depth:
+                    stack.extend(('{}.{}'.format(path, key), child, depth + 1) for key, child in value.iteritems())
+            elif type_name == 'array':
+                if depth < self.max_depth:
+                    stack.extend((path + '[]', child, depth + 1) for child in value[:self.max_list_items])
             else:
-                result_fields[field] = 1
-
-    logging.info("Number of different case names: {}\n".format(len(case_names)))
-    for case_name, occurrences in case_names.iteritems():
-        logging.info("Case name '{}' occurred {} times".format(case_name, occurrences))
-    logging.info('')
-    for field, occurrences in result_fields.iteritems():
-        logging.info("Field '{}' occurred {} times".format(field, occurrences))
-    logging.info('')
-
-
-def _process_lists(parent, child_key):
-    # leave 0 length lists, flatten 1 length lists and process >2 length lists
-    processed_list = parent[child_key]
-    if len(processed_list) == 1:
-        # flatten
-        parent[child_key] = {}
-        processed_list_value = processed_list[0]
-        if isinstance(processed_list_value, dict):
-            # move one level up
-            for single_list_key, single_list_value in processed_list_value.iteritems():
-                parent[child_key][single_list_key] = single_list_value
-        else:
-            # either a list or string
-            parent[child_key] = processed_list_value
-
-
-def _get_list_from_children(parent, child_key):
-    processed_child = parent[child_key]
-    if isinstance(processed_child, dict):
-        for key, value in processed_child.iteritems():
-            returned_list = _get_list_from_children(processed_child, key)
-            if returned_list is not None:
-                return returned_list
-    elif isinstance(processed_child, list):
-        if len(processed_child) < 2:
-            _process_lists(parent, child_key)
-        else:
-            return parent, child_key
+                field['distinct'].add(value)
 
+    def profile(self, test_results):
+        """
+        Pass test_results through while profiling them
+        """
+        for test_result in test_results:
+            self.update(test_result)
+            yield test_result
 
-def _shallow_dict_copy(dictionary):
-    if isinstance(dictionary, dict):
-        copied_dict = copy.copy(dictionary)
-        for key, value in copied_dict.iteritems():
-            copied_dict[key] = _shallow_dict_copy(value)
-    else:
-        copied_dict = dictionary
+    def report(self):
+        cases = {}
+        for case_name, case in self._cases.iteritems():
+            fields = {}
+            for path, field in case['fields'].iteritems():
+                fields[path] = {
+                    'presence': float(field['present']) / case['count'],
+                    'types': field['types'],
+                    'distinct': field['distinct'].estimate()
+                }
+            cases[case_name] = {'count': case['count'], 'fields': fields, 'untracked_fields': case['untracked_fields']}
+        return {'test_results': self.nr_of_test_results, 'unprofiled_test_results': self.nr_of_unprofiled,
+                'cases': cases}
 
-    return copied_dict
+
+def _replace_at(document, path, value):
+    """
+    Return document with value at path, only the dicts along path are copied, the rest is shared
+    """
+    replaced = dict(document)
+    parent = replaced
+    for key in path[:-1]:
+        parent[key] = dict(parent[key])
+        parent = parent[key]
+    parent[path[-1]] = value
+    return replaced
 
 
-def split_testcases(test_result):
+def _find_list_to_split(document):
+    """
+    Depth first search under details for the first list with more than one entry,
+    0 length lists are left and 1 length lists are flattened on the way. As in the original recursive split,
+    the entry of a flattened list is not searched again until the document is searched after a split
+
+    :return: tuple of the (flattened) document, path to the list and the list; path is None if there is none
+    """
+    stack = [(('details',), document['details'])]
+    while stack:
+        path, node = stack.pop()
+        if isinstance(node, list):
+            if len(node) == 1:
+                document = _replace_at(document, path, node[0])
+            elif len(node) > 1:
+                return document, path, node
+        elif isinstance(node, dict):
+            stack.extend((path + (key,), value) for key, value in reversed(node.items()))
+    return document, None, None
+
+
+def split_testcases(test_result, max_split=None):
     """
     1. search for all lists in test_result
     2. ignore 0 length lists, flatten 1 length lists
     3. split longer lists, create new json for each list entry and repeat for each json
 
+    The jsons are yielded lazily and share the parts which were not split with test_result and with each other,
+    so they must not be modified
+
     :param test_result: json object
-    :return:
+    :param max_split: maximal number of jsons yielded for test_result, None means no limit
+    :return: generator of jsons
     """
-    # def split_list_into_categories(list_of_dictionaries):
-    #     # return a list of lists of dictionaries, each list represents one category
-    #     categories = []
-    #     for dictionary in list_of_dictionaries:
-    #         categorized = False
-    #         for category in categories:
-    #             # if a match is found, append to category, which is a list
-    #             category_representative = category[0]
-    #             if set(category_representative.keys()) == set(dictionary.keys()):
-    #                 category.append(dictionary)
-    #                 categorized = True
-    #                 break
-    #
-    #         # if a match is not found, create a new category, which is a list
-    #         if not categorized:
-    #             categories.append([dictionary])
-    #
-    #     return categories
-
-    list_of_split_test_results = []
-    remaining_list = _get_list_from_children(test_result, 'details')
-    if remaining_list is None:
-        # no lists that need splitting were found
-        list_of_split_test_results.append(_shallow_dict_copy(test_result))
-    else:
-        # this list of tuples contains parents with child lists with length > 1
-        (remaining_list_parent, remaining_list_key) = remaining_list
-        # split entries into categories by looking at their dictionary keys
-        # only one category should contain more than one entry
-        # split this category and append the entries from other categories (somehow, if possible)
-        remaining_list = remaining_list_parent[remaining_list_key]
-        for remaining_list_entry in remaining_list:
-            remaining_list_parent[remaining_list_key] = remaining_list_entry
-            t = split_testcases(test_result)
-            list_of_split_test_results.extend(t)
-
-    return list_of_split_test_results
+    pending = [test_result]
+    nr_of_splits = 0
+    while pending:
+        document, path, split_list = _find_list_to_split(pending.pop())
+        if path is None:
+            if max_split is not None and nr_of_splits >= max_split:
+                logging.warning("Test result with case name '{}' split into more than {} results, dropping the rest"
+                                .format(test_result.get('case_name'), max_split))
+                return
+            nr_of_splits += 1
+            yield document
+        else:
+            pending.extend(_replace_at(document, path, entry) for entry in reversed(split_list))
+
+
+def parse_test_result(test_result, max_split=None):
+    """
+    Rename and split one test result into json lines, runs in the worker processes with --output-dir
+    """
+    test_result = logstash_utils.add_timestamp(rename_conflicting_fields(test_result))
+    return [json.dumps(parsed_test_result) for parsed_test_result in split_testcases(test_result, max_split)]
+
+
+class ShardedJsonLinesWriter(object):
+    def __init__(self, directory, nr_of_shards, max_shard_bytes, prefix='test_result', buffer_size=1 << 20,
+                 run_id=None):
+        """
+        Write json lines round robin into nr_of_shards files <prefix>-<run id>-<shard>-<sequence>.log in directory,
+        a file is rotated to the next sequence once it would grow over max_shard_bytes. The files of every run
+        have their own names, so files of earlier runs which logstash may still be reading are never truncated
+
+        :param run_id: defaults to the start time and process id
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.run_id = run_id or '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid())
+        self.max_shard_bytes = max_shard_bytes
+        self.buffer_size = buffer_size
+        self._files = [None] * nr_of_shards
+        self._sizes = [0] * nr_of_shards
+        self._sequences = [0] * nr_of_shards
+        self._next_shard = 0
+
+    def _open(self, shard):
+        path = os.path.join(self.directory, '{}-{}-{}-{:04}.log'.format(self.prefix, self.run_id, shard,
+                                                                       self._sequences[shard]))
+        self._files[shard] = open(path, 'w', self.buffer_size)
+        self._sizes[shard] = 0
+
+    def write_lines(self, lines):
+        """
+        Write lines into the next shard, lines of one call are kept together
+        """
+        if not lines:
+            return
+        shard = self._next_shard
+        self._next_shard = (shard + 1) % len(self._files)
+
+        data = '\n'.join(lines) + '\n'
+        if self._files[shard] is None:
+            self._open(shard)
+        elif self._sizes[shard] > 0 and self._sizes[shard] + len(data) > self.max_shard_bytes:
+            self._files[shard].close()
+            self._sequences[shard] += 1
+            self._open(shard)
+        self._files[shard].write(data)
+        self._sizes[shard] += len(data)
+
+    def close(self):
+        for shard_file in self._files:
+            if shard_file is not None:
+                shard_file.close()
+
+
+def write_shards(test_results, writer, nr_of_workers, max_split=None, chunk_size=16):
+    """
+    Parse test_results in nr_of_workers processes and write them with writer
+    """
+    # multiprocessing.Pool would otherwise read the whole input ahead of the workers
+    test_results = pipeline.BoundedIterable(test_results, nr_of_workers * chunk_size * 4)
+    pool = multiprocessing.Pool(nr_of_workers)
+    try:
+        for lines in pool.imap_unordered(functools.partial(parse_test_result, max_split=max_split), test_results,
+                                         chunk_size):
+            test_results.release()
+            writer.write_lines(lines)
+        pool.close()
+    except BaseException:
+        test_results.stop()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        writer.close()
+
 
 if __name__ == '__main__':
-    logging.basicConfig(filename='/var/log/mongo2elk.log', format='%(asctime)s %(levelname)s: %(message)s', level=logging.DEBUG)
+    log_path = '/var/log/mongo2elk.log'
+    logging.basicConfig(filename=log_path, format='%(asctime)s %(levelname)s: %(message)s', level=logging.DEBUG)
     parser = argparse.ArgumentParser(description='Modify mongo json dump for logstash')
     parser.add_argument('input', help='Input json file to modify')
+    parser.add_argument('-sr', '--schema-report', metavar='PATH',
+                        help='write a json profile of the test result fields to PATH, it is logged otherwise')
+    parser.add_argument('-ms', '--max-split', type=int, metavar='N',
+                        help='split each test result into at most N results, unlimited by default')
+    parser.add_argument('-o', '--output-dir',
+                        help='write json lines into rotated shard files in this directory using worker processes'
+                             ' instead of printing them')
+    parser.add_argument('-s', '--shards', default=4, type=int,
+                        help='number of shard files written at the same time with --output-dir, defaults to 4')
+    parser.add_argument('-w', '--workers', default=multiprocessing.cpu_count(), type=int,
+                        help='number of worker processes with --output-dir, defaults to the number of cpus')
+    parser.add_argument('-mb', '--max-shard-bytes', default=256 << 20, type=int,
+                        help='size at which shard files are rotated, defaults to 256MiB')
+    parser.add_argument('-l', '--logstash', metavar='HOST:PORT',
+                        help='send json lines to a logstash tcp input with json_lines codec instead of printing them')
+    parser.add_argument('--profile', action='store_true',
+                        help='write cProfile stats, stage timings and peak memory as json next to the log')
     args = parser.parse_args()
+    if args.profile:
+        profiling.start(log_path)
     input_json_path = args.input
 
     with open(input_json_path) as input_json_fdesc:
-        input_json = json.load(input_json_fdesc)
+        test_results = json_stream.JsonStreamReader(input_json_fdesc).iter_array('test_results')
+        schema_profiler = SchemaProfiler()
+        test_results = profiling.timed_iter('read', schema_profiler.profile(test_results))
 
-    test_results_section = input_json['test_results']
-
-    analyze_testcases(test_results_section)
-
-    parsed_test_results = []
-
-    for test_result in test_results_section:
-        rename_conflicting_fields(test_result)
-
-        new_test_results = split_testcases(test_result)
-        parsed_test_results.extend(new_test_results)
+        if args.output_dir is not None:
+            write_shards(test_results, ShardedJsonLinesWriter(args.output_dir, args.shards, args.max_shard_bytes),
+                         args.workers, args.max_split)
+        else:
+            # test results can be large, so only a few of them, or of their lists of lines, wait between the stages
+            stages = [pipeline.map_stage(profiling.timed('transform',
+                                                         functools.partial(parse_test_result,
+                                                                           max_split=args.max_split)))]
+            if args.logstash is not None:
+                with logstash_utils.JsonLinesTcpSink(*logstash_utils.parse_address(args.logstash)) as sink:
+                    pipeline.run(test_results, stages,
+                                 pipeline.for_each_in_lists(profiling.timed('publish', sink.write_line)),
+                                 queue_size=4, chunk_size=1)
+            else:
+                pipeline.run(test_results, stages,
+                             pipeline.for_each_in_lists(profiling.timed('publish',
+                                                                        lambda line: sys.stdout.write(line + '\n'))),
+                             queue_size=4, chunk_size=1)
 
-    for parsed_test_result in parsed_test_results:
-        print json.dumps(parsed_test_result)
+    schema_report = schema_profiler.report()
+    for case_name, case_report in schema_report['cases'].iteritems():
+        logging.info("Case name '{}' occurred {} times".format(case_name, case_report['count']))
+    if args.schema_report is None:
+        logging.info('Schema report: {}'.format(json.dumps(schema_report, sort_keys=True)))
+    else:
+        with open(args.schema_report, 'w') as schema_report_fdesc:
+            json.dump(schema_report, schema_report_fdesc, indent=2, sort_keys=True)
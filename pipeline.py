@@ -0,0 +1,225 @@
+"""
+Streaming pipelines of a source, transform stages and a sink
+
+    pipeline.run(source, [pipeline.map_stage(parse), pipeline.flat_map_stage(split)], pipeline.write_lines(sys.stdout))
+
+A source is any iterable, a stage is a callable taking an iterator and returning an iterator and a sink is a callable
+consuming an iterator, whose return value is returned by run. The source and every stage run in their own thread and
+pass items downstream in chunks through bounded queues, so reading, transforming and publishing overlap while a slow
+sink holds back the stages in front of it instead of letting them buffer everything in memory.
+"""
+import Queue
+import subprocess
+import sys
+import threading
+
+_done = object()
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(queue, item, stopped):
+    while not stopped.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Queue.Full:
+            pass
+    raise _Stopped()
+
+
+def _produce(iterable, queue, stopped, chunk_size):
+    try:
+        _produce_chunks(iterable, queue, stopped, chunk_size)
+    finally:
+        # run the finally blocks of generators abandoned after a stop, e.g. to reap a command
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+def _produce_chunks(iterable, queue, stopped, chunk_size):
+    try:
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                _put(queue, chunk, stopped)
+                chunk = []
+        if chunk:
+            _put(queue, chunk, stopped)
+        _put(queue, _done, stopped)
+    except _Stopped:
+        pass
+    except BaseException:
+        try:
+            _put(queue, _Failure(sys.exc_info()), stopped)
+        except _Stopped:
+            pass
+
+
+def _consume(queue, stopped):
+    while True:
+        try:
+            chunk = queue.get(timeout=0.1)
+        except Queue.Empty:
+            if stopped.is_set():
+                raise _Stopped()
+            continue
+        if chunk is _done:
+            return
+        if isinstance(chunk, _Failure):
+            # re-raise in the consuming thread with the original traceback
+            raise chunk.exc_info[0], chunk.exc_info[1], chunk.exc_info[2]
+        for item in chunk:
+            yield item
+
+
+def run(source, stages, sink, queue_size=64, chunk_size=128):
+    """
+    Stream source through stages into sink, failures of any stage are raised here
+
+    :param queue_size: number of chunks buffered between two stages
+    :param chunk_size: number of items passed downstream at once
+    :return: return value of sink
+    """
+    stopped = threading.Event()
+    threads = []
+    iterator = source
+    try:
+        for stage in [iter] + list(stages):
+            queue = Queue.Queue(queue_size)
+            thread = threading.Thread(target=_produce, args=(stage(iterator), queue, stopped, chunk_size))
+            # a stage blocked on reading its input must not keep the process alive
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+            iterator = _consume(queue, stopped)
+        return sink(iterator)
+    finally:
+        # the stages notice the stop on their next put or get, waiting for them keeps them from running into
+        # the interpreter shutdown after a failure
+        stopped.set()
+        for thread in threads:
+            while thread.is_alive():
+                # with a timeout, so that the wait stays interruptible
+                thread.join(0.1)
+
+
+class BoundedIterable(object):
+    def __init__(self, iterable, limit):
+        """
+        Hand out the items of iterable while fewer than limit of them are unreleased, so that e.g. a pool
+        does not read its whole input ahead of its workers
+
+        :param limit: number of items handed out before the iteration waits for release
+        """
+        self._iterable = iterable
+        self._semaphore = threading.Semaphore(limit)
+        self._stopped = False
+
+    def __iter__(self):
+        for item in self._iterable:
+            self._semaphore.acquire()
+            if self._stopped:
+                return
+            yield item
+
+    def release(self):
+        """
+        Mark one handed out item as done
+        """
+        self._semaphore.release()
+
+    def stop(self):
+        """
+        End the iteration, also while it waits for release. A pool reading the items cannot terminate before
+        """
+        self._stopped = True
+        self._semaphore.release()
+
+
+def map_stage(func):
+    """
+    Stage applying func to every item, None results are dropped
+    """
+    def stage(items):
+        for item in items:
+            result = func(item)
+            if result is not None:
+                yield result
+    return stage
+
+
+def flat_map_stage(func):
+    """
+    Stage yielding every item of the iterables func returns
+    """
+    def stage(items):
+        for item in items:
+            for result in func(item):
+                yield result
+    return stage
+
+
+def command_lines(args):
+    """
+    Source of the stdout lines of a command, raises CalledProcessError once the lines are consumed if it failed
+    """
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    try:
+        for line in process.stdout:
+            yield line
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, args)
+
+
+def for_each(func):
+    """
+    Sink calling func for every item
+
+    :return: sink returning the number of items
+    """
+    def sink(items):
+        count = 0
+        for item in items:
+            func(item)
+            count += 1
+        return count
+    return sink
+
+
+def for_each_in_lists(func):
+    """
+    Sink calling func for every element of the lists it consumes, e.g. of the lines split from one large item,
+    which then passes downstream as one item
+
+    :return: sink returning the number of elements
+    """
+    def sink(lists):
+        count = 0
+        for items in lists:
+            for item in items:
+                func(item)
+            count += len(items)
+        return count
+    return sink
+
+
+def write_lines(fobj):
+    """
+    Sink writing every item as a line into fobj
+
+    :return: sink returning the number of lines
+    """
+    return for_each(lambda line: fobj.write(line + '\n'))
@@ -0,0 +1,192 @@
+"""
+Opt-in profiling of the scripts, enabled with their --profile option
+
+While started, every thread is profiled with cProfile and time is accumulated in named spans (read, parse, transform,
+publish). At exit a json report with the spans, the peak memory and the most expensive functions is written next
+to the log of the script, together with the merged cProfile stats for pstats or snakeviz:
+
+    {
+        "argv": [...],
+        "wall_s": 12.3,
+        "cpu_s": 10.1,
+        "spans": {"publish": {"count": 1000, "wall_s": 8.2, "cpu_s": 1.3}, ...},
+        "memory": {"source": "tracemalloc" or "max_rss", "peak_kb": 51200, "top_allocations": [...]},
+        "functions": [{"function": "file:line(name)", "calls": 10, "tottime_s": 0.1, "cumtime_s": 2.0}, ...]
+    }
+
+Without a started profiler span, timed and timed_iter cost next to nothing, so they can stay in the code.
+Spans may overlap and run in several threads at once, cpu_s is the cpu time of the process where the interpreter
+cannot measure it per thread.
+"""
+import atexit
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 has no tracemalloc, the peak is taken from the max rss instead
+    tracemalloc = None
+
+_process_time = getattr(time, 'process_time', None) or time.clock
+_cpu_time = getattr(time, 'thread_time', None) or _process_time
+_max_functions = 50
+_max_allocations = 20
+
+_profiler = None
+
+
+class Profiler(object):
+    def __init__(self, report_path):
+        self.report_path = report_path
+        self.stats_path = os.path.splitext(report_path)[0] + '.pstats'
+        self._lock = threading.Lock()
+        self._spans = {}
+        self._profiles = []
+        self._start_wall = None
+        self._start_cpu = None
+
+    def _profile_thread(self, frame, event, arg):
+        # called once at the start of every new thread, enabling a profile replaces this hook
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        threading.setprofile(self._profile_thread)
+        self._profile_thread(None, None, None)
+        self._start_wall = time.time()
+        self._start_cpu = _process_time()
+
+    def add_span(self, name, wall, cpu):
+        with self._lock:
+            span = self._spans.setdefault(name, {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+            span['count'] += 1
+            span['wall_s'] += wall
+            span['cpu_s'] += cpu
+
+    def _get_memory(self):
+        if tracemalloc is None:
+            return {'source': 'max_rss', 'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        _, peak = tracemalloc.get_traced_memory()
+        top_allocations = [{'location': '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                            'size_kb': stat.size // 1024, 'count': stat.count}
+                           for stat in tracemalloc.take_snapshot().statistics('lineno')[:_max_allocations]]
+        return {'source': 'tracemalloc', 'peak_kb': peak // 1024, 'top_allocations': top_allocations}
+
+    def _get_functions(self, stats):
+        functions = []
+        for (file_name, line, function), (_, calls, tottime, cumtime, _) in sorted(
+                stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:_max_functions]:
+            functions.append({'function': '{}:{}({})'.format(file_name, line, function), 'calls': calls,
+                              'tottime_s': tottime, 'cumtime_s': cumtime})
+        return functions
+
+    def stop(self):
+        """
+        Stop profiling and write the report and the cProfile stats
+        """
+        wall = time.time() - self._start_wall
+        cpu = _process_time() - self._start_cpu
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = None
+        for profile in profiles:
+            profile.disable()
+            try:
+                profile_stats = pstats.Stats(profile)
+            except TypeError:
+                # the thread did not call anything
+                continue
+            if stats is None:
+                stats = profile_stats
+            else:
+                stats.add(profile_stats)
+        report = {
+            'argv': sys.argv,
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'spans': self._spans,
+            'memory': self._get_memory(),
+            'functions': [],
+            'pstats': None
+        }
+        if stats is not None:
+            stats.dump_stats(self.stats_path)
+            report['functions'] = self._get_functions(stats)
+            report['pstats'] = self.stats_path
+        if tracemalloc is not None:
+            tracemalloc.stop()
+        with open(self.report_path, 'w') as report_fdesc:
+            json.dump(report, report_fdesc, indent=2, sort_keys=True)
+
+
+def get_report_path(log_path):
+    return os.path.splitext(log_path)[0] + '.profile.json'
+
+
+def start(log_path):
+    """
+    Profile the rest of the process, the report is written next to log_path when the process exits
+    """
+    global _profiler
+    _profiler = Profiler(get_report_path(log_path))
+    _profiler.start()
+    atexit.register(_profiler.stop)
+    return _profiler
+
+
+@contextlib.contextmanager
+def span(name):
+    if _profiler is None:
+        yield
+        return
+    start_wall, start_cpu = time.time(), _cpu_time()
+    try:
+        yield
+    finally:
+        _profiler.add_span(name, time.time() - start_wall, _cpu_time() - start_cpu)
+
+
+def timed(name, func):
+    """
+    :return: func recording every call in span name, or func itself if profiling was not started
+    """
+    if _profiler is None:
+        return func
+
+    def timed_func(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+    return timed_func
+
+
+def timed_iter(name, iterable):
+    """
+    :return: iterable recording the time spent producing every item in span name,
+             or iterable itself if profiling was not started
+    """
+    if _profiler is None:
+        return iterable
+
+    def timed_items():
+        iterator = iter(iterable)
+        while True:
+            with span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    return timed_items()
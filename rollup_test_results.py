@@ -0,0 +1,164 @@
+#! /usr/bin/env python
+import logging_utils
+import argparse
+import shared_utils
+import datetime
+import itertools
+import urlparse
+import sys
+import create_kibana_dashboards
+import mongo_to_elasticsearch
+
+_log_path = '/var/log/rollup_test_results.log'
+logger = logging_utils.get_logger('rollup_test_results', _log_path)
+
+_rollup_index = 'test_results_rollup'
+_rollup_document_type = 'rollup'
+
+# one summary per combination of these and day
+_group_fields = ('project_name', 'case_name', 'installer', 'pod_name', 'version')
+# terms size of every group field
+_max_terms = 10000
+
+
+def get_rollup_metrics(visualization_details):
+    """
+    :return: sorted list of (metric type, field) of the avg and sum metrics visualized for a testcase
+    """
+    metrics = set()
+    for visualization_detail in visualization_details:
+        for metric in visualization_detail['metrics']:
+            # sum is the default of VisualizationState
+            metric_type = metric.get('type', 'sum')
+            if metric_type in ('avg', 'sum'):
+                metrics.add((metric_type, metric['params']['field']))
+    return sorted(metrics)
+
+
+def _set_field(document, field, value):
+    keys = field.split('.')
+    for key in keys[:-1]:
+        document = document.setdefault(key, {})
+    document[keys[-1]] = value
+
+
+def iter_rollups(elastic_url, es_user, es_passwd, project_name, case_name, metrics, since=None):
+    """
+    Yield the daily summaries of a testcase, computed by elasticsearch in nested terms and date_histogram
+    aggregations. A summary stores every metric under the name of its field, so that the generated visualizations
+    work unchanged on the rollup index: the sum of daily sums is exact, the avg of daily avgs weights days equally
+    """
+    # dynamically mapped strings are analyzed text, their keyword sub-field holds the exact values
+    bucket_aggs = [(field, {'terms': {'field': '{}.keyword'.format(field), 'size': _max_terms}})
+                   for field in _group_fields]
+    bucket_aggs.append(('day', {'date_histogram': {'field': 'creation_date', 'interval': '1d', 'min_doc_count': 1}}))
+    filters = [{'term': {'project_name.keyword': project_name}}, {'term': {'case_name.keyword': case_name}}]
+    if since is not None:
+        filters.append({'range': {'creation_date': {'gte': since.strftime('%Y-%m-%dT00:00:00.000Z')}}})
+    # field names may contain dots, which aggregation names should not
+    metric_aggs = dict(('metric{}'.format(i), {metric_type: {'field': field}})
+                       for i, (metric_type, field) in enumerate(metrics))
+
+    aggregations = shared_utils.search_aggregations(elastic_url, es_user, es_passwd,
+                                                    shared_utils.nest_aggregations(bucket_aggs, metric_aggs),
+                                                    {'bool': {'filter': filters}})
+    for keys, bucket in shared_utils.iter_nested_buckets(aggregations, [name for name, _ in bucket_aggs]):
+        rollup = dict(zip(_group_fields, keys))
+        rollup['creation_date'] = datetime.datetime.utcfromtimestamp(keys[-1] / 1000).strftime(
+            '%Y-%m-%dT%H:%M:%S.000Z')
+        rollup['doc_count'] = bucket['doc_count']
+        for i, (metric_type, field) in enumerate(metrics):
+            value = bucket['metric{}'.format(i)]['value']
+            if value is not None:
+                _set_field(rollup, field, value)
+        yield rollup
+
+
+def _get_rollup_id(rollup):
+    # the same summary is overwritten when its day is rolled up again
+    rollup_id = '-'.join([rollup[field] for field in _group_fields] + [rollup['creation_date'][:10]])
+    return rollup_id.replace(' ', '-').replace('/', '-')
+
+
+def install_rollup_index(elastic_url, es_user, es_passwd):
+    """
+    Map the rollup index like the test results and register it as a kibana index pattern
+    """
+    template = {
+        'template': _rollup_index,
+        'mappings': {
+            _rollup_document_type: {
+                'properties': dict([(field, {'type': 'keyword'}) for field in _group_fields] + [
+                    ('creation_date', {'type': 'date'}),
+                    ('doc_count', {'type': 'long'}),
+                    ('details', {'dynamic': False, 'properties': mongo_to_elasticsearch._details_mapping})
+                ])
+            }
+        }
+    }
+    shared_utils.put_json(template, es_user, es_passwd,
+                          urlparse.urljoin(elastic_url, '/_template/{}'.format(_rollup_index)))
+    shared_utils.put_json({'title': _rollup_index, 'timeFieldName': 'creation_date'}, es_user, es_passwd,
+                          urlparse.urljoin(elastic_url, '/.kibana/index-pattern/{}'.format(_rollup_index)))
+
+
+def rollup_test_results(elastic_url, es_user, es_passwd, since=None, batch_size=500):
+    """
+    Roll up the test results of all testcases in create_kibana_dashboards._testcases since the given day
+
+    :return: number of summaries which could not be indexed
+    """
+    test_results_url = urlparse.urljoin(elastic_url, '/{}/{}'.format(mongo_to_elasticsearch._index_alias,
+                                                                      mongo_to_elasticsearch._document_type))
+    bulk_url = urlparse.urljoin(elastic_url, '/_bulk')
+    nr_of_rollups = 0
+    nr_of_failed = 0
+    for project_name, case_name, visualization_details in create_kibana_dashboards._testcases:
+        rollups = iter_rollups(test_results_url, es_user, es_passwd, project_name, case_name,
+                               get_rollup_metrics(visualization_details), since)
+        actions = (({'index': {'_index': _rollup_index, '_type': _rollup_document_type,
+                               '_id': _get_rollup_id(rollup)}}, rollup) for rollup in rollups)
+        while True:
+            batch = list(itertools.islice(actions, batch_size))
+            if not batch:
+                break
+            nr_of_rollups += len(batch)
+            for action, error in shared_utils.bulk_request(batch, es_user, es_passwd, bulk_url):
+                logger.error("indexing rollup '{}' failed: {}".format(action['index']['_id'], error))
+                nr_of_failed += 1
+
+    logger.info('{} daily summaries rolled up, {} failed'.format(nr_of_rollups, nr_of_failed))
+    return nr_of_failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain daily summaries of the test results in the {} index,'
+                                                 ' which create_kibana_dashboards can visualize instead of the'
+                                                 ' test results'.format(_rollup_index))
+    parser.add_argument('-e', '--elasticsearch-url', default='http://localhost:9200',
+                        help='the url of elasticsearch, defaults to http://localhost:9200')
+
+    parser.add_argument('-u', '--elasticsearch-username',
+                        help='the username for elasticsearch')
+
+    parser.add_argument('-p', '--elasticsearch-password',
+                        help='the password for elasticsearch')
+
+    parser.add_argument('-d', '--days', type=int, metavar='N',
+                        help='roll up only the last N days, including today.'
+                             ' If not present, the whole history is rolled up')
+
+    parser.add_argument('-b', '--bulk-size', default=500, type=int,
+                        help='number of summaries indexed in one _bulk request, defaults to 500')
+
+    args = parser.parse_args()
+    es_user = args.elasticsearch_username
+    es_passwd = args.elasticsearch_password
+
+    since = None
+    if args.days is not None:
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=args.days - 1)
+
+    install_rollup_index(args.elasticsearch_url, es_user, es_passwd)
+    if rollup_test_results(args.elasticsearch_url, es_user, es_passwd, since, args.bulk_size) > 0:
+        sys.exit(1)
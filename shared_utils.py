@@ -1,29 +1,103 @@
 import urllib3
 import json
+import sys
+import threading
+import time
+import urlparse
 http = urllib3.PoolManager()
 
+# concurrent publishers, e.g. the shards of mongo_to_elasticsearch, must not interleave their lines
+_stdout_lock = threading.Lock()
+
+
+def _get_headers(username, password):
+    if username is None and password is None:
+        return {}
+    return urllib3.util.make_headers(basic_auth=':'.join([username or '', password or '']))
+
 
 def delete_request(url, username, password, body=None):
-    headers = urllib3.util.make_headers(basic_auth=':'.join([username, password]))
+    headers = _get_headers(username, password)
     http.request('DELETE', url, headers=headers, body=body)
 
 
+def put_json(json_obj, username, password, url):
+    headers = _get_headers(username, password)
+    return http.request('PUT', url, headers=headers, body=json.dumps(json_obj))
+
+
+def get_json(url, username, password, body=None):
+    headers = _get_headers(username, password)
+    return json.loads(http.request('GET', url, headers=headers, body=body).data)
+
+
 def publish_json(json_ojb, username, password, output_destination):
     json_dump = json.dumps(json_ojb)
     if output_destination == 'stdout':
-        print json_dump
+        with _stdout_lock:
+            sys.stdout.write(json_dump + '\n')
     else:
-        headers = urllib3.util.make_headers(basic_auth=':'.join([username, password]))
+        headers = _get_headers(username, password)
         http.request('POST', output_destination, headers=headers, body=json_dump)
 
 
+def _is_rejected(item_result):
+    # elasticsearch is overloaded, the item can be sent again later
+    return item_result.get('status') == 429 or \
+        item_result.get('error', {}).get('type') == 'es_rejected_execution_exception'
+
+
+def bulk_request(actions, username, password, bulk_url, max_retries=4, retry_delay=0.5):
+    """
+    Send actions in one _bulk request. Actions rejected because elasticsearch is overloaded, with 429 for the
+    whole request or es_rejected_execution_exception for single items, are sent again up to max_retries times,
+    waiting retry_delay seconds before the first retry and twice as long before each further one
+
+    :param actions: list of (action, source) tuples, source is None for delete actions
+    :return: list of (action, error) tuples of the actions which failed
+    """
+    headers = _get_headers(username, password)
+    headers['Content-Type'] = 'application/x-ndjson'
+    errors = []
+    for retry in range(max_retries + 1):
+        if retry:
+            time.sleep(retry_delay * 2 ** (retry - 1))
+        lines = []
+        for action, source in actions:
+            lines.append(json.dumps(action))
+            if source is not None:
+                lines.append(json.dumps(source))
+
+        response = http.request('POST', bulk_url, headers=headers, body='\n'.join(lines) + '\n')
+        if response.status >= 300:
+            # the whole request was rejected
+            rejected = [(action, source, 'HTTP {}: {}'.format(response.status, response.data))
+                        for action, source in actions]
+            if response.status != 429:
+                break
+        else:
+            bulk_json = json.loads(response.data)
+            rejected = []
+            if bulk_json['errors']:
+                for (action, source), item in zip(actions, bulk_json['items']):
+                    item_result = item.values()[0]
+                    if _is_rejected(item_result):
+                        rejected.append((action, source, item_result.get('error')))
+                    elif 'error' in item_result:
+                        errors.append((action, item_result['error']))
+        if not rejected:
+            return errors
+        actions = [(action, source) for action, source, _ in rejected]
+    return errors + [(action, error) for action, _, error in rejected]
+
+
 def _get_nr_of_hits(elastic_json):
     return elastic_json['hits']['total']
 
 
 def get_elastic_data(elastic_url, username, password, body, field='_source'):
     # 1. get the number of results
-    headers = urllib3.util.make_headers(basic_auth=':'.join([username, password]))
+    headers = _get_headers(username, password)
     elastic_json = json.loads(http.request('GET', elastic_url + '/_search?size=0', headers=headers, body=body).data)
     nr_of_hits = _get_nr_of_hits(elastic_json)
 
@@ -34,3 +108,77 @@ def get_elastic_data(elastic_url, username, password, body, field='_source'):
     for hit in elastic_json['hits']['hits']:
         elastic_data.append(hit[field])
     return elastic_data
+
+
+def search_aggregations(elastic_url, username, password, aggs, query=None):
+    """
+    Run aggs in a search without hits
+
+    :return: the aggregations of the response, a failed or partial search raises RuntimeError with the error
+             reported by elasticsearch, instead of being taken for an empty result
+    """
+    body = {'size': 0, 'aggs': aggs}
+    if query is not None:
+        body['query'] = query
+    elastic_json = get_json(elastic_url + '/_search', username, password, body=json.dumps(body))
+    if 'error' in elastic_json or 'aggregations' not in elastic_json:
+        raise RuntimeError('Aggregation on {} failed: {}'.format(elastic_url,
+                                                                 json.dumps(elastic_json.get('error', elastic_json))))
+    if elastic_json.get('_shards', {}).get('failed'):
+        raise RuntimeError('Aggregation on {} failed on {} shards: {}'.format(
+            elastic_url, elastic_json['_shards']['failed'], json.dumps(elastic_json['_shards'].get('failures'))))
+    return elastic_json['aggregations']
+
+
+def nest_aggregations(bucket_aggs, leaf_aggs=None):
+    """
+    Nest every bucket aggregation in the buckets of the previous one
+
+    :param bucket_aggs: list of (name, aggregation) tuples, e.g. ('installer', {'terms': {'field': ..., 'size': 100}})
+    :param leaf_aggs: aggregations computed for every innermost bucket
+    """
+    aggs = leaf_aggs
+    for name, agg in reversed(bucket_aggs):
+        agg = dict(agg)
+        if aggs:
+            agg['aggs'] = aggs
+        aggs = {name: agg}
+    return aggs
+
+
+def iter_nested_buckets(aggregations, names, keys=()):
+    """
+    Yield (keys, bucket) of every innermost bucket of aggregations built by nest_aggregations,
+    keys is the tuple of the keys of the enclosing buckets. Buckets left out by a too small terms size raise
+    RuntimeError, since the result would be silently incomplete
+    """
+    if not names:
+        yield keys, aggregations
+        return
+    aggregation = aggregations[names[0]]
+    if aggregation.get('sum_other_doc_count'):
+        raise RuntimeError("Terms aggregation '{}' left out {} documents, its size is too small".format(
+            names[0], aggregation['sum_other_doc_count']))
+    for bucket in aggregation['buckets']:
+        for item in iter_nested_buckets(bucket, names[1:], keys + (bucket['key'],)):
+            yield item
+
+
+def iter_elastic_hits(elastic_url, username, password, body=None, scroll='1m', page_size=1000):
+    """
+    Yield all hits of a search page by page through the scroll api, instead of fetching them in one response
+    """
+    headers = _get_headers(username, password)
+    elastic_json = json.loads(http.request('POST', elastic_url + '/_search?scroll={}&size={}'.format(scroll, page_size),
+                                           headers=headers, body=body).data)
+    scroll_url = urlparse.urljoin(elastic_url, '/_search/scroll')
+    try:
+        while elastic_json['hits']['hits']:
+            for hit in elastic_json['hits']['hits']:
+                yield hit
+            elastic_json = json.loads(http.request('POST', scroll_url, headers=headers,
+                                                   body=json.dumps({'scroll': scroll,
+                                                                    'scroll_id': elastic_json['_scroll_id']})).data)
+    finally:
+        if '_scroll_id' in elastic_json:
+            delete_request(scroll_url, username, password, body=json.dumps({'scroll_id': elastic_json['_scroll_id']}))
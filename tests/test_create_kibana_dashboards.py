@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import create_kibana_dashboards
+import fake_elasticsearch
+
+
+class _Dashboard(dict):
+    def __init__(self, test_family, label, installer, pod, dashboard_id):
+        super(_Dashboard, self).__init__(metadata={'test_family': test_family, 'label': label})
+        self.installer = installer
+        self.pod = pod
+        self.id = dashboard_id
+
+
+class JsInputsWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.js_file_path = os.path.join(self.directory, 'conf.js')
+
+    def _write(self, *dashboards):
+        create_kibana_dashboards.generate_js_inputs(self.js_file_path, 'http://kibana/', dashboards)
+        with open(self.js_file_path) as js_file:
+            manifest_line, links_line = js_file.read().splitlines()
+        self.assertTrue(manifest_line.startswith('var kibana_dashboard_manifest = '))
+        self.assertTrue(links_line.startswith('var kibana_dashboard_links = '))
+        manifest = json.loads(manifest_line.split(' = ', 1)[1].rstrip(';'))
+        links = json.loads(links_line.split(' = ', 1)[1].rstrip(';'))
+        return manifest, links
+
+    def _family_files(self):
+        return sorted(file_name for file_name in os.listdir(self.directory) if file_name != 'conf.js')
+
+    def test_manifest_family_files_and_links(self):
+        manifest, links = self._write(_Dashboard('VIM', 'tempest duration', 'fuel', 'pod1', 'dashboard-1'),
+                                      _Dashboard('VIM', 'tempest duration', 'apex', 'pod2', 'dashboard-2'),
+                                      _Dashboard('Features', 'promise duration', 'fuel', 'pod1', 'dashboard-3'))
+        self.assertEqual(manifest['dashboard_url'], 'http://kibana/#/dashboard/')
+        self.assertEqual(sorted(manifest['test_families']), ['Features', 'VIM'])
+        self.assertEqual(self._family_files(), sorted(manifest['test_families'].values()))
+        with open(os.path.join(self.directory, manifest['test_families']['VIM'])) as family_file:
+            self.assertEqual(json.load(family_file), {'tempest duration': {'fuel': {'pod1': 'dashboard-1'},
+                                                                           'apex': {'pod2': 'dashboard-2'}}})
+        self.assertEqual(links['Features'], {'promise duration': {'fuel': {'pod1': 'http://kibana/#/dashboard/'
+                                                                                   'dashboard-3'}}})
+
+    def test_family_files_of_the_previous_manifest_are_kept(self):
+        first = self._write(_Dashboard('VIM', 'label', 'fuel', 'pod1', 'dashboard-1'))[0]['test_families']['VIM']
+        second = self._write(_Dashboard('VIM', 'label', 'fuel', 'pod2', 'dashboard-1'))[0]['test_families']['VIM']
+        self.assertEqual(self._family_files(), sorted([first, second]))
+        third = self._write(_Dashboard('VIM', 'label', 'fuel', 'pod3', 'dashboard-1'))[0]['test_families']['VIM']
+        self.assertEqual(self._family_files(), sorted([second, third]))
+
+    def test_conf_js_without_manifest_is_replaced(self):
+        with open(self.js_file_path, 'w') as js_file:
+            js_file.write("var kibana_dashboard_links = {'VIM': {}}")
+        manifest = self._write(_Dashboard('VIM', 'label', 'fuel', 'pod1', 'dashboard-1'))[0]
+        self.assertEqual(self._family_files(), manifest['test_families'].values())
+
+
+class SyncDashboardsTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_elasticsearch.FakeElasticsearch().start()
+        self.addCleanup(self.fake.stop)
+        for name, value in [('base_elastic_url', self.fake.url), ('es_user', None), ('es_passwd', None)]:
+            self.addCleanup(setattr, create_kibana_dashboards, name, getattr(create_kibana_dashboards, name, None))
+            setattr(create_kibana_dashboards, name, value)
+
+        project_name, case_name, visualization_details = create_kibana_dashboards._testcases[0]
+        self.dashboards = [create_kibana_dashboards.KibanaDashboard(project_name, case_name, 'fuel', pod,
+                                                                    ['v1', 'v2'], visualization_details[0])
+                           for pod in ('pod1', 'pod2')]
+
+    def _saved_objects(self):
+        return dict(((hit['_type'], hit['_id']), hit['_source'])
+                    for hit in self.fake.search('.kibana', None, {})[0])
+
+    def _sync(self, dashboards):
+        self.fake.reset_stats()
+        self.assertEqual(create_kibana_dashboards.sync_dashboards(dashboards), 0)
+        return self.fake.stats['endpoints'].get('POST _bulk', 0)
+
+    def test_only_changed_saved_objects_are_published(self):
+        self.assertEqual(self._sync(self.dashboards), 1)
+        saved_objects = self._saved_objects()
+        self.assertEqual(sorted(saved_objects), sorted(saved_object[:2] for dashboard in self.dashboards
+                                                       for saved_object in dashboard.saved_objects()))
+        for (object_type, object_id), body in saved_objects.iteritems():
+            self.assertEqual(body['metadata']['content_hash'],
+                             create_kibana_dashboards._get_content_hash(dict(
+                                 body, metadata=dict((key, value) for key, value in body['metadata'].iteritems()
+                                                     if key != 'content_hash'))))
+
+        self.assertEqual(self._sync(self.dashboards), 0)
+
+        self.dashboards[0]['description'] = 'changed'
+        self.assertEqual(self._sync(self.dashboards), 1)
+        self.assertEqual(self._saved_objects()[('dashboard', self.dashboards[0].id)]['description'], 'changed')
+
+    def test_only_generated_saved_objects_are_pruned(self):
+        self._sync(self.dashboards)
+        # same id prefix as the generated dashboards, but created by hand
+        self.fake.index_document('.kibana', 'dashboard', 'functest-Tempest-by-hand', {'title': 'by hand'})
+
+        self._sync(self.dashboards[:1])
+        self.assertEqual(sorted(self._saved_objects()),
+                         sorted([saved_object[:2] for saved_object in self.dashboards[0].saved_objects()] +
+                                [('dashboard', 'functest-Tempest-by-hand')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fake_elasticsearch
+import shared_utils
+
+
+def _request(method, url, body=None):
+    response = shared_utils.http.request(method, url, body=None if body is None else json.dumps(body), retries=False)
+    return response.status, json.loads(response.data)
+
+
+class _FakeElasticsearchTest(unittest.TestCase):
+    options = {}
+
+    def setUp(self):
+        self.fake = fake_elasticsearch.FakeElasticsearch(**self.options).start()
+        self.addCleanup(self.fake.stop)
+
+
+class BulkTest(_FakeElasticsearchTest):
+    def test_index_and_delete(self):
+        errors = shared_utils.bulk_request([({'index': {'_index': 'i', '_type': 't', '_id': '1'}}, {'a': 1}),
+                                            ({'index': {'_index': 'i', '_type': 't', '_id': '2'}}, {'a': 2}),
+                                            ({'delete': {'_index': 'i', '_type': 't', '_id': '1'}}, None)],
+                                           None, None, self.fake.url + '/_bulk')
+        self.assertEqual(errors, [])
+        self.assertEqual(_request('GET', self.fake.url + '/i/t/1')[0], 404)
+        self.assertEqual(_request('GET', self.fake.url + '/i/t/2'),
+                         (200, {'_index': 'i', '_type': 't', '_id': '2', 'found': True, '_source': {'a': 2}}))
+
+    def test_item_errors_are_reported(self):
+        update = {'update': {'_index': 'i', '_type': 't', '_id': '1'}}
+        errors = shared_utils.bulk_request([({'index': {'_index': 'i', '_type': 't', '_id': '1'}}, {'a': 1}),
+                                            (update, {'doc': {'a': 2}})],
+                                           None, None, self.fake.url + '/_bulk')
+        self.assertEqual(errors, [(update, {'type': 'illegal_argument_exception',
+                                            'reason': 'unsupported bulk action'})])
+
+
+class SearchTest(_FakeElasticsearchTest):
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        for number in range(10):
+            self.fake.index_document('results-{}'.format(number % 2), 'result', str(number),
+                                     {'pod': 'pod{}'.format(number % 3), 'number': number,
+                                      'start_date': '2017-01-0{}T12:00:00'.format(number % 3 + 1)})
+
+    def test_scroll_returns_all_hits_and_clears_the_scroll(self):
+        hits = list(shared_utils.iter_elastic_hits(self.fake.url + '/results-*', None, None,
+                                                   body=json.dumps({'query': {'match_all': {}}}), page_size=3))
+        self.assertEqual(sorted(hit['_source']['number'] for hit in hits), range(10))
+        self.assertEqual(self.fake._scrolls, {})
+
+    def test_source_filtering(self):
+        self.fake.index_document('other', 'result', '1', {'a': {'b': 1, 'c': 2}, 'd': 3})
+        self.assertEqual([hit['_source'] for hit in self.fake.search('other', None, {'_source': ['a.b', 'd']})[0]],
+                         [{'a': {'b': 1}, 'd': 3}])
+        self.assertEqual([hit['_source'] for hit in self.fake.search('other', None, {'_source': 'a'})[0]],
+                         [{'a': {'b': 1, 'c': 2}}])
+        self.assertNotIn('_source', self.fake.search('other', None, {'_source': False})[0][0])
+
+    def test_terms_keeps_the_largest_buckets_and_counts_the_others(self):
+        aggregations = shared_utils.search_aggregations(self.fake.url + '/results-*', None, None,
+                                                        {'pods': {'terms': {'field': 'pod.keyword', 'size': 2}}})
+        self.assertEqual(aggregations['pods'], {'buckets': [{'key': 'pod0', 'doc_count': 4},
+                                                            {'key': 'pod1', 'doc_count': 3}],
+                                                'sum_other_doc_count': 3})
+
+    def test_nested_date_histogram_and_metric(self):
+        aggs = shared_utils.nest_aggregations([('pods', {'terms': {'field': 'pod.keyword', 'size': 10}}),
+                                               ('days', {'date_histogram': {'field': 'start_date',
+                                                                            'interval': 'day'}})],
+                                              {'number': {'max': {'field': 'number'}}})
+        aggregations = shared_utils.search_aggregations(self.fake.url + '/results-*', None, None, aggs,
+                                                        query={'range': {'number': {'gte': 3}}})
+        self.assertEqual([(keys, bucket['doc_count'], bucket['number']['value'])
+                          for keys, bucket in shared_utils.iter_nested_buckets(aggregations, ['pods', 'days'])],
+                         [(('pod0', 1483228800000), 3, 9),
+                          (('pod1', 1483315200000), 2, 7),
+                          (('pod2', 1483401600000), 2, 8)])
+
+
+class ThrottleTest(_FakeElasticsearchTest):
+    options = {'throttle_rate': 1}
+
+    def test_requests_are_rejected_with_429(self):
+        self.assertEqual(_request('GET', self.fake.url + '/_cat/indices'),
+                         (429, {'error': {'type': 'es_rejected_execution_exception',
+                                          'reason': 'injected throttling'}, 'status': 429}))
+        self.assertEqual(self.fake.stats['throttled'], 1)
+
+    def test_failed_bulk_reports_every_action(self):
+        actions = [({'index': {'_index': 'i', '_type': 't', '_id': str(number)}}, {'a': number})
+                   for number in range(3)]
+        errors = shared_utils.bulk_request(actions, None, None, self.fake.url + '/_bulk', max_retries=0)
+        self.assertEqual([action for action, _ in errors], [action for action, _ in actions])
+        self.assertTrue(all(error.startswith('HTTP 429') for _, error in errors))
+
+
+class RateLimitTest(_FakeElasticsearchTest):
+    options = {'max_requests_per_second': 2}
+
+    def test_requests_above_the_rate_are_rejected(self):
+        # retried until the three requests fall into the same second
+        while True:
+            self.fake.reset_stats()
+            statuses = [_request('GET', self.fake.url + '/_cat/indices')[0] for _ in range(3)]
+            if self.fake._requests_in_second == 3:
+                break
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(self.fake.stats['throttled'], 1)
+
+
+class ErrorTest(_FakeElasticsearchTest):
+    options = {'error_rate': 1}
+
+    def test_requests_fail_with_500(self):
+        self.assertEqual(_request('PUT', self.fake.url + '/i/t/1', {'a': 1}),
+                         (500, {'error': {'type': 'exception', 'reason': 'injected error'}, 'status': 500}))
+        self.assertEqual(self.fake.stats['errors'], 1)
+        self.assertEqual(self.fake.search('_all', None, {})[0], [])
+
+    def test_search_aggregations_raises(self):
+        self.assertRaisesRegexp(RuntimeError, 'injected error', shared_utils.search_aggregations,
+                                self.fake.url + '/results-*', None, None, {'pods': {'terms': {'field': 'pod'}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import StringIO
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import json_stream
+
+
+class JsonStreamReaderTest(unittest.TestCase):
+    def _assert_every_chunk_size(self, text, read, expected):
+        for chunk_size in range(1, len(text) + 1):
+            reader = json_stream.JsonStreamReader(StringIO.StringIO(text), chunk_size)
+            self.assertEqual(list(read(reader)), expected, 'chunk size {}'.format(chunk_size))
+
+    def test_numbers_split_across_chunks(self):
+        self._assert_every_chunk_size('[1.5, 2, -30, 1.5e-3, 2E+10, 0.25]', lambda reader: reader.iter_array(),
+                                      [1.5, 2, -30, 1.5e-3, 2E+10, 0.25])
+
+    def test_array_under_key(self):
+        self._assert_every_chunk_size('{"meta": {"n": 12.5}, "test_results": [{"a": 1}, {"b": [2.5]}], "x": 3}',
+                                      lambda reader: reader.iter_array('test_results'), [{'a': 1}, {'b': [2.5]}])
+
+    def test_values(self):
+        self._assert_every_chunk_size('{"a": 1}\n12.75\n"s"\n', lambda reader: reader.iter_values(),
+                                      [{'a': 1}, 12.75, 's'])
+
+    def test_missing_key(self):
+        reader = json_stream.JsonStreamReader(StringIO.StringIO('{"meta": 1}'))
+        self.assertRaises(KeyError, list, reader.iter_array('test_results'))
+
+
+if __name__ == '__main__':
+    unittest.main()
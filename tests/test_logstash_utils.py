@@ -0,0 +1,106 @@
+import os
+import SocketServer
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logstash_utils
+
+
+class ToTimestampTest(unittest.TestCase):
+    def test_mongo_date_without_offset(self):
+        self.assertEqual(logstash_utils.to_timestamp('2016-05-03 12:34:56.123456'), '2016-05-03T12:34:56.123Z')
+
+    def test_offsets_are_converted_to_utc(self):
+        self.assertEqual(logstash_utils.to_timestamp('2016-05-03T12:34:56Z'), '2016-05-03T12:34:56.000Z')
+        self.assertEqual(logstash_utils.to_timestamp('2016-05-03T01:34:56.5+0200'), '2016-05-02T23:34:56.500Z')
+        self.assertEqual(logstash_utils.to_timestamp('2016-05-03T23:34:56-02:30'), '2016-05-04T02:04:56.000Z')
+
+    def test_unknown_suffix(self):
+        self.assertRaises(ValueError, logstash_utils.to_timestamp, '2016-05-03 12:34:56 UTC')
+
+
+
+class _LinesServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_first_connection=False):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _LinesHandler)
+        self.drop_first_connection = drop_first_connection
+        self.connections = []
+        self.dropped = threading.Event()
+        self.lock = threading.Lock()
+
+    def lines(self):
+        with self.lock:
+            return ''.join(''.join(chunks) for chunks in self.connections).splitlines()
+
+
+class _LinesHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            chunks = []
+            self.server.connections.append(chunks)
+            drop = self.server.drop_first_connection and len(self.server.connections) == 1
+        while True:
+            data = self.request.recv(1 << 16)
+            if not data:
+                return
+            with self.server.lock:
+                chunks.append(data)
+            if drop and data.endswith('\n'):
+                # gone after the first batch, like a restarted logstash
+                self.request.close()
+                self.server.dropped.set()
+                return
+
+
+class JsonLinesTcpSinkTest(unittest.TestCase):
+    def _start_server(self, **kwargs):
+        server = _LinesServer(**kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _wait_for_lines(self, server, count):
+        deadline = time.time() + 5
+        while len(server.lines()) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return server.lines()
+
+    def test_lines_are_sent_in_batches(self):
+        server = self._start_server()
+        sink = logstash_utils.JsonLinesTcpSink('127.0.0.1', server.server_address[1], batch_bytes=25)
+        sink.write({'n': 1})
+        sink.write({'n': 2})
+        time.sleep(0.1)
+        self.assertEqual(server.lines(), [])
+        sink.write({'n': 3})
+        self.assertEqual(self._wait_for_lines(server, 3), ['{"n": 1}', '{"n": 2}', '{"n": 3}'])
+        sink.close()
+
+    def test_batch_is_resent_after_reconnect(self):
+        server = self._start_server(drop_first_connection=True)
+        sink = logstash_utils.JsonLinesTcpSink('127.0.0.1', server.server_address[1], batch_bytes=1, retry_delay=0.01)
+        sink.write_line('first')
+        self.assertTrue(server.dropped.wait(5))
+        sink.write_line('second')
+        self.assertEqual(self._wait_for_lines(server, 2), ['first', 'second'])
+        self.assertEqual(len(server.connections), 2)
+        sink.close()
+
+    def test_close_flushes_the_remainder(self):
+        server = self._start_server()
+        with logstash_utils.JsonLinesTcpSink('127.0.0.1', server.server_address[1]) as sink:
+            sink.write_line('last')
+        self.assertEqual(self._wait_for_lines(server, 1), ['last'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+import copy
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fake_elasticsearch
+import mongo_to_elasticsearch
+
+
+def _date(day, hour=0, minute=0):
+    return datetime.datetime(2024, 11, day, hour, minute)
+
+
+def _test_result(pod_name):
+    return {'_id': {'$oid': pod_name}, 'installer': 'fuel', 'pod_name': pod_name, 'version': 'master',
+            'case_name': 'vPing', 'project_name': 'functest', 'creation_date': '2024-11-19 10:00:00.123456',
+            'details': {'duration': 10, 'status': 'OK'}}
+
+
+def _aggregated(case_name, details, **fields):
+    aggregated = {'installer': 'fuel', 'pod_name': 'pod1', 'version': 'master', 'case_name': case_name,
+                  'project_name': 'functest', 'creation_date': '2024-11-19 10:00:00.123456', 'details': details}
+    aggregated.update(fields)
+    return aggregated
+
+
+class MongoEntrySchemaTest(unittest.TestCase):
+    def setUp(self):
+        self.schema = mongo_to_elasticsearch.MongoEntrySchema(mandatory=('a',), transformed={'b': int},
+                                                              optional=('c',), drop=('d',))
+
+    def test_mandatory_transformed_and_optional_fields_are_kept(self):
+        self.assertEqual(self.schema.project({'a': 1, 'b': '2', 'c': 3, 'd': 4, 'e': 5}), {'a': 1, 'b': 2, 'c': 3})
+
+    def test_optional_field_with_none_is_removed(self):
+        self.assertEqual(self.schema.project({'a': 1, 'b': '2', 'c': None}), {'a': 1, 'b': 2})
+
+    def test_missing_or_none_mandatory_field_is_invalid(self):
+        self.assertIsNone(self.schema.project({'a': 1, 'c': 3}))
+        self.assertIsNone(self.schema.project({'a': None, 'b': '2'}))
+        self.assertIsNone(self.schema.project({'a': 1, 'b': None}))
+
+    def test_keep_unknown_removes_only_drop_fields(self):
+        schema = mongo_to_elasticsearch.MongoEntrySchema(mandatory=('a',), optional=('c',), drop=('d',),
+                                                         keep_unknown=True)
+        self.assertEqual(schema.project({'a': 1, 'c': None, 'd': 4, 'e': 5}), {'a': 1, 'e': 5})
+
+    def test_input_is_left_untouched(self):
+        testcase = {'a': 1, 'b': '2', 'd': 4}
+        self.schema.project(testcase)
+        self.assertEqual(testcase, {'a': 1, 'b': '2', 'd': 4})
+
+
+class ModifyMongoEntryTest(unittest.TestCase):
+    def _modify(self, case_name, details):
+        test_result = dict(_test_result('pod1'), case_name=case_name, details=details)
+        original = copy.deepcopy(test_result)
+        modified = mongo_to_elasticsearch.modify_mongo_entry(test_result)
+        # the modified testcase shares no changed state with the mongo document
+        self.assertEqual(test_result, original)
+        return modified
+
+    def test_default_entry_keeps_only_the_counters(self):
+        modified = self._modify('vPing', {'duration': '0:00:10', 'tests': 2, 'failures': 0, 'status': 'OK'})
+        self.assertEqual(modified['details'], {'duration': 10.0, 'tests': 2, 'failures': 0})
+        self.assertNotIn('_id', modified)
+        self.assertIsNone(self._modify('vPing', {'status': 'OK'}))
+
+    def test_tempest_success_percentage(self):
+        self.assertEqual(self._modify('Tempest', {'duration': 5, 'tests': 4, 'failures': 1, 'errors': []})['details'],
+                         {'duration': 5, 'tests': 4, 'failures': 1, 'success_percentage': 75.0})
+
+    def test_onos_results_are_counted(self):
+        statuses = [{'Case result': 'PASS', 'Case name:': 'a'}, {'Case result': 'FAIL', 'Case name:': 'b'}]
+        details = self._modify('ONOS', {'FUNCvirNet': {'duration': '0:01:00', 'status': statuses},
+                                        'FUNCvirNetL3': {'duration': 30, 'status': statuses[:1]}})['details']
+        self.assertEqual(details, {'FUNCvirNet': {'duration': 60.0, 'tests': 2, 'failures': 1},
+                                   'FUNCvirNetL3': {'duration': 30.0, 'tests': 1, 'failures': 0}})
+
+
+class ModifyAggregatedEntryTest(unittest.TestCase):
+    def test_odl_success_percentage(self):
+        self.assertEqual(mongo_to_elasticsearch.modify_aggregated_entry(
+            _aggregated('ODL', {'tests': 4, 'failures': 1, 'passed': 3}))['details'],
+            {'tests': 4, 'failures': 1, 'success_percentage': 75.0})
+
+    def test_odl_without_tests_is_skipped(self):
+        self.assertIsNone(mongo_to_elasticsearch.modify_aggregated_entry(
+            _aggregated('ODL', {'tests': 0, 'failures': 0, 'passed': 0})))
+
+    def test_vims_without_tests_is_skipped(self):
+        self.assertIsNone(mongo_to_elasticsearch.modify_aggregated_entry(_aggregated('vIMS', {
+            'sig_test': {'duration': 1, 'tests': 0, 'failures': 0, 'passed': 0, 'skipped': 0},
+            'vIMS': {'duration': 2}, 'orchestrator': {'duration': 3}})))
+
+    def test_onos_durations_are_converted(self):
+        details = mongo_to_elasticsearch.modify_aggregated_entry(_aggregated('ONOS', {
+            'FUNCvirNet': {'duration': '0:01:30.5', 'tests': 2, 'failures': 0},
+            'FUNCvirNetL3': {'duration': '1:00:00', 'tests': 3, 'failures': 1}}))['details']
+        self.assertEqual(details, {'FUNCvirNet': {'duration': 90.5, 'tests': 2, 'failures': 0},
+                                   'FUNCvirNetL3': {'duration': 3600.0, 'tests': 3, 'failures': 1}})
+
+    def test_input_is_left_untouched(self):
+        aggregated = _aggregated('ODL', {'tests': 4, 'failures': 1, 'passed': 3})
+        original = copy.deepcopy(aggregated)
+        mongo_to_elasticsearch.modify_aggregated_entry(aggregated)
+        self.assertEqual(aggregated, original)
+
+    def test_entry_missing_a_mandatory_field_is_skipped(self):
+        self.assertIsNone(mongo_to_elasticsearch.modify_aggregated_entry(
+            _aggregated('ODL', {'tests': 1, 'failures': 0, 'passed': 1}, pod_name=None)))
+
+    def test_aggregated_mongo_data(self):
+        aggregations = {'ODL': [_aggregated('ODL', {'tests': 2, 'failures': 1, 'passed': 1}),
+                                _aggregated('ODL', {'tests': 0, 'failures': 0, 'passed': 0})],
+                        'vIMS': [],
+                        'ONOS': [_aggregated('ONOS', {'FUNCvirNet': {'duration': 1, 'tests': 1, 'failures': 0},
+                                                      'FUNCvirNetL3': {'duration': 2, 'tests': 1, 'failures': 0}})]}
+
+        def run_mongo_aggregation(pipeline):
+            # the first stage matches the case name
+            return [json.dumps(test_result) for test_result in aggregations[pipeline[0]['$match']['case_name']]]
+
+        run_mongo_aggregation_before = mongo_to_elasticsearch._run_mongo_aggregation
+        mongo_to_elasticsearch._run_mongo_aggregation = run_mongo_aggregation
+        try:
+            aggregated_data = mongo_to_elasticsearch.get_aggregated_mongo_data()
+        finally:
+            mongo_to_elasticsearch._run_mongo_aggregation = run_mongo_aggregation_before
+        self.assertEqual([(test_result['case_name'], test_result['details']) for test_result in aggregated_data],
+                         [('ODL', {'tests': 2, 'failures': 1, 'success_percentage': 50.0}),
+                          ('ONOS', {'FUNCvirNet': {'duration': 1, 'tests': 1, 'failures': 0},
+                                    'FUNCvirNetL3': {'duration': 2, 'tests': 1, 'failures': 0}})])
+
+
+class GetShardsTest(unittest.TestCase):
+    def test_first_shard_starts_at_since_and_the_others_at_midnight(self):
+        self.assertEqual(mongo_to_elasticsearch.get_shards(_date(18, 15, 30), _date(21, 10), 1),
+                         [(_date(18, 15, 30), _date(19)), (_date(19), _date(20)), (_date(20), _date(21)),
+                          (_date(21), _date(21, 10))])
+        self.assertEqual(mongo_to_elasticsearch.get_shards(_date(18, 15, 30), _date(21, 10), 2),
+                         [(_date(18, 15, 30), _date(20)), (_date(20), _date(21, 10))])
+
+    def test_window_starting_at_midnight(self):
+        self.assertEqual(mongo_to_elasticsearch.get_shards(_date(18), _date(20), 1),
+                         [(_date(18), _date(19)), (_date(19), _date(20))])
+
+    def test_window_within_a_shard(self):
+        self.assertEqual(mongo_to_elasticsearch.get_shards(_date(18, 1), _date(18, 2), 3),
+                         [(_date(18, 1), _date(18, 2))])
+        self.assertEqual(mongo_to_elasticsearch.get_shards(_date(18, 1), _date(18, 1), 3), [])
+
+
+class GetOnlyShardTest(unittest.TestCase):
+    def test_shard_starts_at_midnight_of_the_date(self):
+        self.assertEqual(mongo_to_elasticsearch.get_only_shard('2024-11-19', 2, _date(25)), [(_date(19), _date(21))])
+
+    def test_shard_is_at_least_one_day_long(self):
+        self.assertEqual(mongo_to_elasticsearch.get_only_shard('2024-11-19', 0, _date(25)), [(_date(19), _date(20))])
+
+    def test_shard_ends_at_until(self):
+        self.assertEqual(mongo_to_elasticsearch.get_only_shard('2024-11-21', 1, _date(21, 10)),
+                         [(_date(21), _date(21, 10))])
+
+
+class MergeShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_elasticsearch.FakeElasticsearch().start()
+        self.addCleanup(self.fake.stop)
+        self.elastic_url = self.fake.url + '/test_results/mongo2elastic'
+
+        # mongoexport stand-in printing the export whatever its query
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.export_path = os.path.join(self.directory, 'export.json')
+        mongoexport_path = os.path.join(self.directory, 'mongoexport')
+        with open(mongoexport_path, 'w') as mongoexport_fdesc:
+            mongoexport_fdesc.write('#!/bin/sh\ncat "{}" || exit 3\n'.format(self.export_path))
+        os.chmod(mongoexport_path, 0755)
+        self.addCleanup(os.environ.__setitem__, 'PATH', os.environ['PATH'])
+        os.environ['PATH'] = self.directory + os.pathsep + os.environ['PATH']
+
+    def _merge(self, shards):
+        return mongo_to_elasticsearch.merge_shards(shards, self.elastic_url, False, self.elastic_url, None, None,
+                                                   parallelism=2, retries=1)
+
+    def test_only_test_results_missing_in_elasticsearch_are_published(self):
+        test_results = [_test_result('pod{}'.format(number)) for number in range(3)]
+        with open(self.export_path, 'w') as export_fdesc:
+            for test_result in test_results:
+                export_fdesc.write(json.dumps(test_result) + '\n')
+        self.fake.index_document('test_results', 'mongo2elastic', None,
+                                 mongo_to_elasticsearch.modify_mongo_entry(test_results[0]))
+
+        self.assertEqual(self._merge(mongo_to_elasticsearch.get_only_shard('2024-11-19', 1, _date(25))), [])
+        self.assertEqual(sorted(hit['_source']['pod_name'] for hit in self.fake.search('test_results', None, {})[0]),
+                         ['pod0', 'pod1', 'pod2'])
+
+    def test_failed_shards_are_returned(self):
+        # no export, so mongoexport fails
+        shards = mongo_to_elasticsearch.get_shards(_date(18, 12), _date(20), 1)
+        self.assertEqual(sorted(self._merge(shards)), shards)
+
+
+if __name__ == '__main__':
+    unittest.main()
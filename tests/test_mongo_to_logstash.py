@@ -0,0 +1,152 @@
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mongo_to_logstash
+
+
+def _split(test_result, max_split=None):
+    original = copy.deepcopy(test_result)
+    split_test_results = list(mongo_to_logstash.split_testcases(test_result, max_split))
+    # the split test results share the unsplit parts, test_result itself is left as it was
+    assert test_result == original
+    return split_test_results
+
+
+class SplitTestcasesTest(unittest.TestCase):
+    def test_without_lists(self):
+        self.assertEqual(_split({'case_name': 'a', 'details': {'b': 1}}), [{'case_name': 'a', 'details': {'b': 1}}])
+
+    def test_long_lists_are_split_and_empty_lists_kept(self):
+        self.assertEqual(_split({'details': {'a': [1, 2, 3], 'b': []}}),
+                         [{'details': {'a': 1, 'b': []}}, {'details': {'a': 2, 'b': []}},
+                          {'details': {'a': 3, 'b': []}}])
+
+    def test_entry_of_a_flattened_list_is_not_split(self):
+        self.assertEqual(_split({'details': [{'s': [1, 2]}]}), [{'details': {'s': [1, 2]}}])
+        self.assertEqual(_split({'details': [[1, 2]]}), [{'details': [1, 2]}])
+
+    def test_split_entries_are_split_again(self):
+        self.assertEqual(_split({'details': [{'x': 1, 'l': [1, 2]}, {'x': 2, 'l': [3]}]}),
+                         [{'details': {'x': 1, 'l': 1}}, {'details': {'x': 1, 'l': 2}}, {'details': {'x': 2, 'l': 3}}])
+
+    def test_max_split(self):
+        self.assertEqual(_split({'details': {'a': [1, 2, 3, 4, 5]}}, max_split=2),
+                         [{'details': {'a': 1}}, {'details': {'a': 2}}])
+
+
+class RenameConflictingFieldsTest(unittest.TestCase):
+    def setUp(self):
+        mongo_to_logstash._renamed_keys.clear()
+
+    def test_conflicting_keys_and_dots_are_renamed(self):
+        self.assertEqual(mongo_to_logstash.rename_conflicting_fields({'_id': 1, 'a.b': [{'_type': 'x', 'c': 2}]}),
+                         {'mongo_id': 1, 'a:b': [{'mongo_type': 'x', 'c': 2}]})
+        self.assertEqual(mongo_to_logstash._renamed_keys, {'_id': 'mongo_id', 'a.b': 'a:b', '_type': 'mongo_type',
+                                                           'c': None})
+
+    def test_taken_keys_get_the_lowest_free_suffix(self):
+        self.assertEqual(mongo_to_logstash.rename_conflicting_fields({'a.b': 1, 'a:b': 2, 'a:b_1': 3}),
+                         {'a:b_2': 1, 'a:b': 2, 'a:b_1': 3})
+
+    def test_cache_is_bounded(self):
+        max_renamed_keys = mongo_to_logstash._max_renamed_keys
+        mongo_to_logstash._max_renamed_keys = 1
+        try:
+            self.assertEqual(mongo_to_logstash.rename_conflicting_fields({'a': {'_id': 1}}), {'a': {'mongo_id': 1}})
+        finally:
+            mongo_to_logstash._max_renamed_keys = max_renamed_keys
+        self.assertEqual(mongo_to_logstash._renamed_keys, {'a': None})
+
+
+class DistinctSketchTest(unittest.TestCase):
+    def _estimate(self, values, k):
+        sketch = mongo_to_logstash.DistinctSketch(k)
+        for value in values:
+            sketch.add(value)
+        return sketch.estimate()
+
+    def test_count_below_k_is_exact(self):
+        self.assertEqual(self._estimate(['a', u'b', 1, 'a', 1.5, u'\xe9'], 8), 5)
+
+    def test_estimate_is_within_the_error_bound(self):
+        k = 256
+        for nr_of_values in (1000, 10000):
+            # repeated values do not change the estimate
+            estimate = self._estimate(['value-{}'.format(number % nr_of_values) for number in xrange(2 * nr_of_values)],
+                                      k)
+            self.assertLess(abs(estimate - nr_of_values), 3 * nr_of_values / k ** 0.5)
+
+
+class SchemaProfilerTest(unittest.TestCase):
+    def test_report(self):
+        profiler = mongo_to_logstash.SchemaProfiler(max_fields=5, max_cases=1)
+        test_results = [{'case_name': 'a', 'details': {'tests': 1}, 'errors': ['x', 'y']},
+                        {'case_name': 'a', 'details': {'tests': 'many'}, 'other': None},
+                        {'case_name': 'b'}]
+        self.assertEqual(list(profiler.profile(test_results)), test_results)
+        # the report is written to --schema-report as json
+        self.assertEqual(json.loads(json.dumps(profiler.report())), {
+            'test_results': 3,
+            'unprofiled_test_results': 1,
+            'cases': {'a': {'count': 2, 'untracked_fields': 1, 'fields': {
+                'case_name': {'presence': 1.0, 'types': {'string': 2}, 'distinct': 1},
+                'details': {'presence': 1.0, 'types': {'object': 2}, 'distinct': 0},
+                'details.tests': {'presence': 1.0, 'types': {'integer': 1, 'string': 1}, 'distinct': 2},
+                'errors': {'presence': 0.5, 'types': {'array': 1}, 'distinct': 0},
+                'errors[]': {'presence': 0.5, 'types': {'string': 2}, 'distinct': 2}}}}})
+
+    def test_depth_and_list_items_are_bounded(self):
+        profiler = mongo_to_logstash.SchemaProfiler(max_depth=2, max_list_items=2)
+        profiler.update({'a': {'b': {'c': 1}}, 'l': [1, 2, 3]})
+        fields = profiler.report()['cases'][None]['fields']
+        self.assertEqual(sorted(fields), ['a', 'a.b', 'l', 'l[]'])
+        self.assertEqual(fields['l[]']['types'], {'integer': 2})
+
+
+class ShardedJsonLinesWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _read_files(self):
+        files = {}
+        for file_name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, file_name)) as shard_file:
+                files[file_name] = shard_file.read()
+        return files
+
+    def test_lines_are_written_round_robin_and_rotated(self):
+        writer = mongo_to_logstash.ShardedJsonLinesWriter(self.directory, 2, 8, run_id='run1')
+        for lines in (['a1'], ['b1', 'b2'], ['a2'], [], ['b3'], ['a3']):
+            writer.write_lines(lines)
+        writer.close()
+        # empty calls do not take a turn, a shard is rotated when the next lines would grow it over 8 bytes
+        self.assertEqual(self._read_files(), {'test_result-run1-0-0000.log': 'a1\na2\n',
+                                              'test_result-run1-0-0001.log': 'a3\n',
+                                              'test_result-run1-1-0000.log': 'b1\nb2\n',
+                                              'test_result-run1-1-0001.log': 'b3\n'})
+
+    def test_files_of_earlier_runs_are_left_alone(self):
+        for run_id, line in (('run1', 'first'), ('run2', 'second')):
+            writer = mongo_to_logstash.ShardedJsonLinesWriter(self.directory, 1, 1024, run_id=run_id)
+            writer.write_lines([line])
+            writer.close()
+        self.assertEqual(self._read_files(), {'test_result-run1-0-0000.log': 'first\n',
+                                              'test_result-run2-0-0000.log': 'second\n'})
+
+    def test_run_id_defaults_to_a_new_name(self):
+        writer = mongo_to_logstash.ShardedJsonLinesWriter(self.directory, 1, 1024)
+        writer.write_lines(['a'])
+        writer.close()
+        file_name, = self._read_files()
+        self.assertRegexpMatches(file_name, r'^test_result-\d{8}T\d{6}-\d+-0-0000\.log$')
+
+
+if __name__ == '__main__':
+    unittest.main()
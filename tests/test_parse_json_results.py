@@ -0,0 +1,45 @@
+import imp
+import os
+import StringIO
+import unittest
+
+_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'elk-scripts', 'parse-json-results.py')
+parse_json_results = imp.load_source('parse_json_results', _script)
+
+
+def _read(text, input_format='auto'):
+    return list(parse_json_results.read_test_results(StringIO.StringIO(text), input_format))
+
+
+class ReadTestResultsTest(unittest.TestCase):
+    def test_auto_reads_test_results_after_other_keys(self):
+        self.assertEqual(_read('{"meta": 1, "test_results": [{"a": 1}, {"b": 2}]}'), [{'a': 1}, {'b': 2}])
+
+    def test_auto_reads_test_results_as_first_key(self):
+        self.assertEqual(_read('{"test_results": [{"a": 1}], "meta": 1}'), [{'a': 1}])
+
+    def test_auto_reads_array(self):
+        self.assertEqual(_read(' [{"a": 1}, {"b": 2}]'), [{'a': 1}, {'b': 2}])
+
+    def test_auto_reads_nothing_from_empty_input(self):
+        self.assertEqual(_read(' \n'), [])
+
+    def test_auto_rejects_jsonl_without_test_results(self):
+        self.assertRaisesRegexp(ValueError, '-f jsonl', _read, '{"a": 1}\n{"b": 2}\n')
+
+    def test_auto_rejects_jsonl_after_test_results(self):
+        test_results = parse_json_results.read_test_results(StringIO.StringIO('{"test_results": [{"a": 1}]}\n'
+                                                                               '{"test_results": [{"b": 2}]}\n'),
+                                                            'auto')
+        self.assertEqual(next(test_results), {'a': 1})
+        self.assertRaisesRegexp(ValueError, '-f jsonl', next, test_results)
+
+    def test_array_rejects_trailing_values(self):
+        self.assertRaisesRegexp(ValueError, '-f jsonl', _read, '[{"a": 1}]\n[{"b": 2}]', 'array')
+
+    def test_jsonl(self):
+        self.assertEqual(_read('{"a": 1}\n\n{"b": 2}\n', 'jsonl'), [{'a': 1}, {'b': 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
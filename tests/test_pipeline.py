@@ -0,0 +1,127 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pipeline
+
+
+def _fail_on(bad_item, result=None):
+    def func(item):
+        if item == bad_item:
+            raise ValueError('bad item {}'.format(item))
+        return item if result is None else result(item)
+    return func
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.threads_before = threading.active_count()
+
+    def tearDown(self):
+        # every stage thread is joined when run returns or raises
+        self.assertEqual(threading.active_count(), self.threads_before)
+
+    def test_order_is_kept(self):
+        self.assertEqual(pipeline.run(xrange(1000), [pipeline.map_stage(lambda item: item * 2),
+                                                     pipeline.flat_map_stage(lambda item: [item, -item])],
+                                      list, queue_size=2, chunk_size=3),
+                         [value for item in xrange(1000) for value in (item * 2, -item * 2)])
+
+    def test_none_results_of_map_are_dropped(self):
+        self.assertEqual(pipeline.run(xrange(6), [pipeline.map_stage(lambda item: item if item % 2 else None)], list),
+                         [1, 3, 5])
+
+    def test_producer_blocks_when_the_queue_is_full(self):
+        produced = []
+        consumed = threading.Event()
+
+        def source():
+            for item in xrange(100):
+                produced.append(item)
+                yield item
+
+        def sink(items):
+            first = next(items)
+            consumed.set()
+            time.sleep(0.3)
+            # queue_size items are queued, one is consumed and one waits to be put
+            self.assertLessEqual(len(produced), 3 + 2)
+            return [first] + list(items)
+
+        self.assertEqual(pipeline.run(source(), [], sink, queue_size=3, chunk_size=1), range(100))
+        self.assertTrue(consumed.is_set())
+
+    def test_map_error_is_raised(self):
+        self.assertRaisesRegexp(ValueError, 'bad item 500', pipeline.run, xrange(1000),
+                                [pipeline.map_stage(_fail_on(500))], list)
+
+    def test_flat_map_error_is_raised(self):
+        self.assertRaisesRegexp(ValueError, 'bad item 500', pipeline.run, xrange(1000),
+                                [pipeline.flat_map_stage(_fail_on(500, lambda item: [item]))], list)
+
+    def test_sink_error_is_raised(self):
+        self.assertRaisesRegexp(ValueError, 'bad item 5', pipeline.run, xrange(100000),
+                                [pipeline.map_stage(lambda item: item)], pipeline.for_each(_fail_on(5)),
+                                queue_size=2, chunk_size=1)
+
+    def test_source_error_is_raised(self):
+        def source():
+            yield 1
+            raise ValueError('bad source')
+
+        self.assertRaisesRegexp(ValueError, 'bad source', pipeline.run, source(), [], list)
+
+    def test_abandoned_source_is_closed(self):
+        closed = threading.Event()
+
+        def source():
+            try:
+                for item in xrange(100000):
+                    yield item
+            finally:
+                closed.set()
+
+        self.assertRaises(ValueError, pipeline.run, source(), [], pipeline.for_each(_fail_on(5)), queue_size=2,
+                          chunk_size=1)
+        self.assertTrue(closed.is_set())
+
+    def test_for_each_in_lists(self):
+        lines = []
+        self.assertEqual(pipeline.run([['a', 'b'], [], ['c']], [], pipeline.for_each_in_lists(lines.append)), 3)
+        self.assertEqual(lines, ['a', 'b', 'c'])
+
+
+class BoundedIterableTest(unittest.TestCase):
+    def _next_in_thread(self, iterator):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(next(iterator, 'end')))
+        thread.daemon = True
+        thread.start()
+        return thread, result
+
+    def test_release_hands_out_the_next_item(self):
+        items = pipeline.BoundedIterable(xrange(10), 2)
+        iterator = iter(items)
+        self.assertEqual([next(iterator), next(iterator)], [0, 1])
+        thread, result = self._next_in_thread(iterator)
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        items.release()
+        thread.join(5)
+        self.assertEqual(result, [2])
+
+    def test_stop_ends_a_waiting_iteration(self):
+        items = pipeline.BoundedIterable(xrange(10), 1)
+        iterator = iter(items)
+        next(iterator)
+        thread, result = self._next_in_thread(iterator)
+        items.stop()
+        thread.join(5)
+        self.assertEqual(result, ['end'])
+
+
+if __name__ == '__main__':
+    unittest.main()
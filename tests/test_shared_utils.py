@@ -0,0 +1,50 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fake_elasticsearch
+import shared_utils
+
+
+class BulkRequestTest(unittest.TestCase):
+    actions = [({'index': {'_index': 'i', '_type': 't', '_id': str(number)}}, {'a': number}) for number in range(20)]
+
+    def _bulk_request(self, max_retries=4, **options):
+        fake = fake_elasticsearch.FakeElasticsearch(seed=1, **options).start()
+        self.addCleanup(fake.stop)
+        errors = shared_utils.bulk_request(self.actions, None, None, fake.url + '/_bulk', max_retries=max_retries,
+                                           retry_delay=0.001)
+        return fake, errors
+
+    def test_throttled_requests_are_retried(self):
+        fake, errors = self._bulk_request(throttle_rate=0.5)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(fake.search('i', None, {})[0]), 20)
+        self.assertGreater(fake.stats['throttled'], 0)
+
+    def test_rejected_items_are_retried(self):
+        fake, errors = self._bulk_request(item_reject_rate=0.5)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(fake.search('i', None, {})[0]), 20)
+        self.assertGreater(fake.stats['throttled'], 0)
+
+    def test_throttled_request_fails_after_max_retries(self):
+        fake, errors = self._bulk_request(max_retries=2, throttle_rate=1)
+        self.assertEqual([action for action, _ in errors], [action for action, _ in self.actions])
+        self.assertEqual(fake.stats['requests'], 3)
+
+    def test_rejected_items_fail_after_max_retries(self):
+        fake, errors = self._bulk_request(max_retries=1, item_reject_rate=1)
+        self.assertEqual(errors, [(action, {'type': 'es_rejected_execution_exception', 'reason': 'injected rejection'})
+                                  for action, _ in self.actions])
+        self.assertEqual(fake.stats['requests'], 2)
+
+    def test_errors_are_not_retried(self):
+        fake, errors = self._bulk_request(error_rate=1)
+        self.assertEqual(len(errors), 20)
+        self.assertEqual(fake.stats['requests'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()